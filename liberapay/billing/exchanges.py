@@ -2,7 +2,10 @@
 """
 from __future__ import division, print_function, unicode_literals
 
+from collections import OrderedDict
 from decimal import Decimal, ROUND_UP
+from multiprocessing.pool import ThreadPool
+import threading
 
 from mangopay.exceptions import APIError
 from mangopay.resources import (
@@ -133,9 +136,55 @@ def create_wallet(db, participant):
          WHERE id = %s
     """, (w.Id, participant.id))
     participant.set_attributes(mangopay_wallet_id=w.Id)
+    forget_mango_ids(participant.id)
     return w.Id
 
 
+# Cache of the Mangopay user and wallet IDs of participants, only complete
+# pairs are stored since they don't change once they've been set
+MANGO_IDS_CACHE_SIZE = 1000
+mango_ids_cache = OrderedDict()
+mango_ids_cache_lock = threading.Lock()
+
+
+def get_mango_ids(db, *p_ids):
+    """Return a dict of `(mangopay_user_id, mangopay_wallet_id)` tuples keyed
+    by participant ID, fetching the ones that aren't cached in a single query.
+    """
+    r = {}
+    with mango_ids_cache_lock:
+        for p_id in p_ids:
+            ids = mango_ids_cache.pop(p_id, None)
+            if ids:
+                mango_ids_cache[p_id] = r[p_id] = ids
+    missing = set(p_ids) - set(r)
+    if not missing:
+        return r
+    rows = db.all("""
+        SELECT id, mangopay_user_id, mangopay_wallet_id
+          FROM participants
+         WHERE id IN %s
+    """, (tuple(missing),))
+    with mango_ids_cache_lock:
+        for p_id, user_id, wallet_id in rows:
+            r[p_id] = (user_id, wallet_id)
+            if user_id and wallet_id:
+                mango_ids_cache[p_id] = r[p_id]
+        while len(mango_ids_cache) > MANGO_IDS_CACHE_SIZE:
+            mango_ids_cache.popitem(last=False)
+    return r
+
+
+def forget_mango_ids(p_id=None):
+    """Remove a participant's IDs from the cache, or all of them if `p_id` is `None`.
+    """
+    with mango_ids_cache_lock:
+        if p_id is None:
+            mango_ids_cache.clear()
+        else:
+            mango_ids_cache.pop(p_id, None)
+
+
 def test_hook():
     return
 
@@ -358,8 +407,8 @@ def propagate_exchange(cursor, participant, exchange, route, error, amount):
         raise NegativeBalance
 
     if amount < 0:
+        # The participant's row has been locked by the UPDATE above
         bundles = cursor.all("""
-            LOCK TABLE cash_bundles IN EXCLUSIVE MODE;
             SELECT b.*
               FROM cash_bundles b
               JOIN exchanges e ON e.id = b.origin
@@ -415,7 +464,7 @@ def propagate_exchange(cursor, participant, exchange, route, error, amount):
 
     if amount != 0:
         participant.update_giving_and_tippees(cursor)
-        merge_cash_bundles(cursor, participant.id)
+        schedule_cash_bundles_merge(cursor, participant.id)
 
 
 def transfer(db, tipper, tippee, amount, context, **kw):
@@ -425,25 +474,43 @@ def transfer(db, tipper, tippee, amount, context, **kw):
              VALUES (%s, %s, %s, %s, %s, %s, 'pre')
           RETURNING id
     """, (tipper, tippee, amount, context, kw.get('team'), kw.get('invoice')))
-    get = lambda id, col: db.one("SELECT {0} FROM participants WHERE id = %s".format(col), (id,))
+    tr = send_transfer(db, t_id, tipper, tippee, amount, **kw)
+    return record_transfer_result(db, t_id, tr)
+
+
+def send_transfer(db, t_id, tipper, tippee, amount, **kw):
+    """Ask Mangopay to execute the transfer `t_id`, without recording the result.
+    """
+    keys = ('tipper_mango_id', 'tipper_wallet_id', 'tippee_mango_id', 'tippee_wallet_id')
+    if not all(kw.get(k) for k in keys):
+        ids = get_mango_ids(db, tipper, tippee)
+        for k, v in zip(keys, ids[tipper] + ids[tippee]):
+            kw[k] = kw.get(k) or v
     tr = Transfer()
-    tr.AuthorId = kw.get('tipper_mango_id') or get(tipper, 'mangopay_user_id')
-    tr.CreditedUserId = kw.get('tippee_mango_id') or get(tippee, 'mangopay_user_id')
-    tr.CreditedWalletId = kw.get('tippee_wallet_id') or get(tippee, 'mangopay_wallet_id')
+    tr.AuthorId = kw['tipper_mango_id']
+    tr.CreditedUserId = kw['tippee_mango_id']
+    tr.CreditedWalletId = kw['tippee_wallet_id']
     if not tr.CreditedWalletId:
         tr.CreditedWalletId = create_wallet(db, Participant.from_id(tippee))
     tr.DebitedFunds = Money(int(amount * 100), 'EUR')
-    tr.DebitedWalletId = kw.get('tipper_wallet_id') or get(tipper, 'mangopay_wallet_id')
+    tr.DebitedWalletId = kw['tipper_wallet_id']
     tr.Fees = Money(0, 'EUR')
     tr.Tag = str(t_id)
     tr.save()
-    return record_transfer_result(db, t_id, tr)
+    return tr
 
 
-def record_transfer_result(db, t_id, tr):
+def get_transfer_result(tr):
+    """Return the `(status, error)` of a Mangopay transfer.
+    """
     error = repr_error(tr)
     status = tr.Status.lower()
     assert (not error) ^ (status == 'failed')
+    return status, error
+
+
+def record_transfer_result(db, t_id, tr):
+    status, error = get_transfer_result(tr)
     return _record_transfer_result(db, t_id, status, error)
 
 
@@ -458,6 +525,7 @@ def _record_transfer_result(db, t_id, status, error=None):
          RETURNING tipper, tippee, amount
         """, (status, error, t_id))
         if status == 'succeeded':
+            lock_participants(c, tipper, tippee)
             balance = c.one("""
 
                 UPDATE participants
@@ -473,49 +541,89 @@ def _record_transfer_result(db, t_id, status, error=None):
             """, locals())
             if balance is None:
                 raise NegativeBalance
-            bundles = c.all("""
-                LOCK TABLE cash_bundles IN EXCLUSIVE MODE;
-                SELECT b.*
-                  FROM cash_bundles b
-                  JOIN exchanges e ON e.id = b.origin
-                 WHERE b.owner = %s
-              ORDER BY e.participant = %s DESC, b.ts
-            """, (tipper, tippee))
-            x = amount
-            for b in bundles:
-                if x >= b.amount:
-                    c.run("""
-                        UPDATE cash_bundles
-                           SET owner = %s
-                         WHERE id = %s
-                    """, (tippee, b.id))
-                    x -= b.amount
-                    if x == 0:
-                        break
-                else:
-                    c.run("""
-                        UPDATE cash_bundles
-                           SET amount = (amount - %s)
-                         WHERE id = %s;
-
-                        INSERT INTO cash_bundles
-                                    (owner, origin, amount, ts)
-                             VALUES (%s, %s, %s, %s);
-                    """, (x, b.id, tippee, b.origin, x, b.ts))
-                    break
+            move_cash_bundles(c, [(tipper, tippee, amount)])
+            schedule_cash_bundles_merge(c, tippee)
     if balance is not None:
-        merge_cash_bundles(db, tippee)
         return balance
     raise TransferError(error)
 
 
-def merge_cash_bundles(db, p_id):
+def lock_participants(cursor, *p_ids):
+    """Lock the rows of the given participants, in a stable order.
+
+    This is what prevents concurrent transactions from modifying the cash
+    bundles of the same participant, without locking the whole table. Only
+    the rows of participants have to be locked, since the functions that move
+    cash bundles always update the balances of their owners.
+    """
+    cursor.run("""
+        SELECT id FROM participants WHERE id = ANY(%s) ORDER BY id FOR UPDATE
+    """, (list(p_ids),))
+
+
+def move_cash_bundles(cursor, transfers):
+    """Move the cash bundles of tippers to tippees, in a single statement.
+
+    `transfers` is a list of `(tipper, tippee, amount)` tuples, in which a
+    tipper can only appear once. The bundles of each tipper are taken in
+    order, starting with the ones that come from the tippee, and the last one
+    is split if needed.
+    """
+    tippers, tippees, amounts = zip(*transfers)
+    cursor.run("""
+        WITH t AS (
+                 SELECT *
+                   FROM unnest(%s::bigint[], %s::bigint[], %s::numeric[])
+                        AS t (tipper, tippee, amount)
+             )
+           , b AS (
+                 SELECT b.id, b.origin, b.amount, b.ts, t.tippee
+                      , t.amount AS transfer_amount
+                      , sum(b.amount) OVER (
+                            PARTITION BY b.owner
+                                ORDER BY e.participant = t.tippee DESC, b.ts, b.id
+                        ) AS running_total
+                   FROM t
+                   JOIN cash_bundles b ON b.owner = t.tipper
+                   JOIN exchanges e ON e.id = b.origin
+             )
+           , moved AS (
+                 SELECT b.*
+                      , least(b.amount, b.transfer_amount - (b.running_total - b.amount)) AS x
+                   FROM b
+                  WHERE b.running_total - b.amount < b.transfer_amount
+             )
+           , whole AS (
+                 UPDATE cash_bundles b
+                    SET owner = m.tippee
+                   FROM moved m
+                  WHERE b.id = m.id
+                    AND m.x = m.amount
+             )
+           , split AS (
+                 UPDATE cash_bundles b
+                    SET amount = (b.amount - m.x)
+                   FROM moved m
+                  WHERE b.id = m.id
+                    AND m.x < m.amount
+             )
+        INSERT INTO cash_bundles
+                    (owner, origin, amount, ts)
+             SELECT tippee, origin, x, ts
+               FROM moved
+              WHERE x < amount;
+    """, (list(tippers), list(tippees), list(amounts)))
+
+
+def merge_cash_bundles(db, *p_ids):
+    """Merge the bundles of each participant that have the same origin.
+    """
     return db.one("""
-        LOCK TABLE cash_bundles IN EXCLUSIVE MODE;
+        SELECT id FROM participants WHERE id = ANY(%(p_ids)s) ORDER BY id FOR UPDATE;
         WITH regroup AS (
                  SELECT owner, origin, sum(amount) AS amount, max(ts) AS ts
                    FROM cash_bundles
-                  WHERE owner = %s
+                  WHERE owner = ANY(%(p_ids)s)
                GROUP BY owner, origin
                  HAVING count(*) > 1
              ),
@@ -536,23 +644,153 @@ def merge_cash_bundles(db, p_id):
              )
         SELECT (SELECT json_agg(d) FROM deleted d) AS before
              , (SELECT json_agg(i) FROM inserted i) AS after
-    """, (p_id,))
+    """, dict(p_ids=list(p_ids)))
+
+
+def schedule_cash_bundles_merge(cursor, *p_ids):
+    """Mark the cash bundles of the given participants as needing to be merged.
+
+    The merging is done later by `merge_scheduled_cash_bundles`.
+    """
+    cursor.run("""
+        INSERT INTO cash_bundles_to_merge
+                    (owner)
+             SELECT unnest(%s::bigint[])
+        ON CONFLICT (owner) DO NOTHING
+    """, (list(p_ids),))
+
+
+def merge_scheduled_cash_bundles(db):
+    """Merge the cash bundles of the participants in `cash_bundles_to_merge`.
+
+    This is a cron job, and it's also called at the end of payday. Returns the
+    number of participants whose bundles have been merged.
+    """
+    with db.get_cursor() as cursor:
+        owners = cursor.all("SELECT owner FROM cash_bundles_to_merge")
+        if not owners:
+            return 0
+        # The participants are locked before the rows of `cash_bundles_to_merge`,
+        # like in the functions that schedule merges
+        merge_cash_bundles(cursor, *owners)
+        cursor.run("""
+            DELETE FROM cash_bundles_to_merge WHERE owner = ANY(%s)
+        """, (owners,))
+    return len(owners)
 
 
-def sync_with_mangopay(db):
+def record_transfer_results(db, results):
+    """Record the results of a batch of transfers in a single transaction.
+
+    `results` is a list of `(t_id, status, error)` tuples, in the order in
+    which the transfers were executed. The cash bundles are moved like in
+    `_record_transfer_result`, but with one statement per group of transfers
+    in which each tipper appears only once and hasn't received money from the
+    previous transfers of the group.
+    """
+    if not results:
+        return
+    with db.get_cursor() as c:
+        t_ids, statuses, errors = zip(*results)
+        transfers = dict((t.id, t) for t in c.all("""
+            UPDATE transfers t
+               SET status = x.status::transfer_status
+                 , error = x.error
+              FROM unnest(%s::int[], %s::text[], %s::text[]) x (id, status, error)
+             WHERE t.id = x.id
+         RETURNING t.id, t.tipper, t.tippee, t.amount
+        """, (list(t_ids), list(statuses), list(errors))))
+        succeeded = [transfers[t_id] for t_id, status, error in results if status == 'succeeded']
+        if not succeeded:
+            return
+        lock_participants(c, *set(
+            [t.tipper for t in succeeded] + [t.tippee for t in succeeded]
+        ))
+        negative = c.one("""
+            WITH deltas AS (
+                     SELECT x.id, sum(x.delta) AS delta
+                       FROM unnest(%s::bigint[], %s::numeric[]) x (id, delta)
+                   GROUP BY x.id
+                 )
+               , updated AS (
+                     UPDATE participants p
+                        SET balance = p.balance + d.delta
+                       FROM deltas d
+                      WHERE p.id = d.id
+                  RETURNING p.id, p.balance
+                 )
+            SELECT count(*) FROM updated WHERE balance < 0
+        """, (
+            [t.tippee for t in succeeded] + [t.tipper for t in succeeded],
+            [t.amount for t in succeeded] + [-t.amount for t in succeeded],
+        ))
+        if negative:
+            raise NegativeBalance
+        groups, group, tippers, tippees = [], [], set(), set()
+        for t in succeeded:
+            if t.tipper in tippers or t.tipper in tippees:
+                groups.append(group)
+                group, tippers, tippees = [], set(), set()
+            group.append((t.tipper, t.tippee, t.amount))
+            tippers.add(t.tipper)
+            tippees.add(t.tippee)
+        groups.append(group)
+        for group in groups:
+            move_cash_bundles(c, group)
+        schedule_cash_bundles_merge(c, *set(t.tippee for t in succeeded))
+
+
+def get_transactions_by_tag(user_ids, concurrency=1):
+    """Fetch the Mangopay transactions of the given users, in up to
+    `concurrency` threads.
+
+    Returns a `{user_id: {tag: [transaction, ...]}}` dict.
+    """
+    def fetch(user_id):
+        by_tag = {}
+        for tr in Transaction.all(user_id=user_id):
+            by_tag.setdefault(tr.Tag, []).append(tr)
+        return user_id, by_tag
+
+    user_ids = list(set(user_ids))
+    if len(user_ids) < 2 or concurrency < 2:
+        return dict(fetch(user_id) for user_id in user_ids)
+    pool = ThreadPool(min(concurrency, len(user_ids)))
+    try:
+        return dict(pool.map(fetch, user_ids))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def sync_with_mangopay(db, concurrency=1):
     """We can get out of sync with MangoPay if record_exchange_result wasn't
     completed. This is where we fix that.
+
+    The transactions of each Mangopay user are only fetched once, in up to
+    `concurrency` threads.
     """
     check_db(db)
 
     exchanges = db.all("SELECT * FROM exchanges WHERE status = 'pre'")
+    transfers = db.all("SELECT * FROM transfers WHERE status = 'pre'")
+    if not exchanges and not transfers:
+        return
+    participants = {p.id: p for p in db.all("""
+        SELECT p
+          FROM participants p
+         WHERE id = ANY(%s)
+    """, (list(set([e.participant for e in exchanges] + [t.tipper for t in transfers])),))}
+    transactions = get_transactions_by_tag(
+        (p.mangopay_user_id for p in participants.values()), concurrency
+    )
+
     for e in exchanges:
-        p = Participant.from_id(e.participant)
-        transactions = Transaction.all(user_id=p.mangopay_user_id)
-        transactions = [x for x in transactions if x.Tag == str(e.id)]
-        assert len(transactions) < 2
-        if transactions:
-            t = transactions[0]
+        p = participants[e.participant]
+        matches = transactions[p.mangopay_user_id].get(str(e.id), [])
+        assert len(matches) < 2
+        if matches:
+            t = matches[0]
             error = repr_error(t)
             status = t.Status.lower()
             assert (not error) ^ (status == 'failed')
@@ -566,14 +804,13 @@ def sync_with_mangopay(db):
                 # Otherwise forget about it
                 db.run("DELETE FROM exchanges WHERE id=%s", (e.id,))
 
-    transfers = db.all("SELECT * FROM transfers WHERE status = 'pre'")
     for t in transfers:
-        tipper = Participant.from_id(t.tipper)
-        transactions = Transaction.all(user_id=tipper.mangopay_user_id)
-        transactions = [x for x in transactions if x.Type == 'TRANSFER' and x.Tag == str(t.id)]
-        assert len(transactions) < 2
-        if transactions:
-            record_transfer_result(db, t.id, transactions[0])
+        tipper = participants[t.tipper]
+        matches = transactions[tipper.mangopay_user_id].get(str(t.id), [])
+        matches = [x for x in matches if x.Type == 'TRANSFER']
+        assert len(matches) < 2
+        if matches:
+            record_transfer_result(db, t.id, matches[0])
         else:
             # The transfer didn't happen, remove it
             db.run("DELETE FROM transfers WHERE id = %s", (t.id,))
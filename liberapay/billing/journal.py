@@ -0,0 +1,132 @@
+"""An append-only file of the transfers that a payday has to execute.
+
+The file starts with a small header, followed by one fixed-width record per
+transfer. The first byte of each record is its state, which is overwritten in
+place when the transfer is started and when it's done. The header contains the
+index of the first record that isn't done yet, so resuming a payday doesn't
+require reading the records that have already been processed.
+"""
+from __future__ import division, print_function, unicode_literals
+
+from decimal import Decimal
+import os
+import struct
+import threading
+
+
+PENDING, STARTED, DONE = 0, 1, 2
+
+HEADER = struct.Struct(str('<4sq'))  # magic, index of the first unfinished record
+RECORD = struct.Struct(str('<Bqqq16sqi20s20s20s20s'))
+MAGIC = b'LPJ1'
+
+MANGO_FIELDS = ('tipper_mango_id', 'tippee_mango_id', 'tipper_wallet_id', 'tippee_wallet_id')
+
+
+def encode(state, t):
+    ids = [(getattr(t, k) or '').encode('ascii') for k in MANGO_FIELDS]
+    assert max(len(v) for v in ids) <= 20, ids
+    return RECORD.pack(
+        state, t.tipper, t.tippee, int(t.amount * 100), t.context.encode('ascii'),
+        t.team or 0, t.invoice or 0, *ids
+    )
+
+
+def decode(data):
+    fields = RECORD.unpack(data)
+    state, tipper, tippee, amount, context, team, invoice = fields[:7]
+    d = dict(
+        tipper=tipper, tippee=tippee, amount=Decimal(amount).scaleb(-2),
+        context=context.rstrip(b'\0').decode('ascii'),
+        team=team or None, invoice=invoice or None,
+    )
+    for k, v in zip(MANGO_FIELDS, fields[7:]):
+        d[k] = v.rstrip(b'\0').decode('ascii') or None
+    return state, d
+
+
+class Journal(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'r+b')
+        magic, self.first_unfinished = HEADER.unpack(self.f.read(HEADER.size))
+        assert magic == MAGIC, "%r is not a payday journal" % path
+        self.lock = threading.Lock()
+        self.done = set()
+
+    @classmethod
+    def create(cls, path, transfers, is_done=None):
+        """Write the `transfers` to a new journal and return it.
+
+        The records are written to a temporary file as they come, the file is
+        only moved to `path` once it's complete. The optional `is_done` callable
+        tells which transfers have already been executed.
+        """
+        tmp_path = path + '.part'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, 0))
+            for t in transfers:
+                f.write(encode(DONE if is_done and is_done(t) else PENDING, t))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+        return cls(path)
+
+    def __len__(self):
+        return (os.fstat(self.f.fileno()).st_size - HEADER.size) // RECORD.size
+
+    def close(self):
+        self.f.close()
+
+    def read(self):
+        """Yield `(index, state, transfer)` tuples for the unfinished records.
+
+        The transfers are dicts.
+        """
+        with self.lock:
+            offset = HEADER.size + self.first_unfinished * RECORD.size
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            i = self.first_unfinished
+            while True:
+                data = f.read(RECORD.size)
+                if len(data) < RECORD.size:
+                    break
+                state, t = decode(data)
+                if state == DONE:
+                    with self.lock:
+                        if i > self.first_unfinished:
+                            self.done.add(i)
+                else:
+                    yield i, state, t
+                i += 1
+
+    def _set_state(self, i, state):
+        self.f.seek(HEADER.size + i * RECORD.size)
+        self.f.write(struct.pack(str('<B'), state))
+
+    def _sync(self):
+        # The state of a record has to survive a crash of the machine, not just
+        # of the process, otherwise a transfer could be executed twice
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def mark_started(self, i):
+        with self.lock:
+            self._set_state(i, STARTED)
+            self._sync()
+
+    def mark_done(self, i):
+        with self.lock:
+            self._set_state(i, DONE)
+            if i == self.first_unfinished:
+                self.first_unfinished += 1
+                while self.first_unfinished in self.done:
+                    self.done.remove(self.first_unfinished)
+                    self.first_unfinished += 1
+                self.f.seek(0)
+                self.f.write(HEADER.pack(MAGIC, self.first_unfinished))
+            else:
+                self.done.add(i)
+            self._sync()
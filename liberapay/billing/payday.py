@@ -2,19 +2,31 @@
 
 from __future__ import print_function, unicode_literals
 
+from collections import defaultdict, deque
 from datetime import date
-from decimal import Decimal, ROUND_UP
+import io
 import os
 import os.path
 import pickle
+import resource
+import sys
+import threading
+import time
 
 from babel.dates import format_timedelta
 import pando.utils
 from psycopg2 import IntegrityError
+from six import reraise
+from six.moves.queue import Queue
 
 from liberapay import constants
-from liberapay.billing.exchanges import transfer
-from liberapay.exceptions import NegativeBalance
+from liberapay.billing.exchanges import (
+    get_transfer_result, merge_scheduled_cash_bundles, record_transfer_results,
+    send_transfer,
+)
+from liberapay.billing.journal import Journal, STARTED
+from liberapay.billing.settlement import NS, TipGraph
+from liberapay.exceptions import NegativeBalance, TransferError
 from liberapay.models.participant import Participant
 from liberapay.utils import group_by
 
@@ -22,21 +34,96 @@ from liberapay.utils import group_by
 log = print
 
 
-def round_up(d):
-    return d.quantize(constants.D_CENT, rounding=ROUND_UP)
-
-
 class NoPayday(Exception):
     __str__ = lambda self: "No payday found where one was expected."
 
 
-class NS(object):
-    def __init__(self, d):
-        self.__dict__.update(d)
+def execute_transfers(transfers, func, concurrency=1):
+    """Call `func(i, t)` for each transfer, in up to `concurrency` threads.
+
+    The transfers that involve the same participant are executed one after the
+    other, in the order of the list, so that a wallet is never debited before
+    it has received the money it's supposed to have, and never debited twice
+    at the same time.
+
+    If `func` raises an exception then no new transfer is started, and the
+    exception is reraised once the ones already in progress have finished.
+    """
+    # Queue the transfers of each participant
+    queues = defaultdict(deque)
+    for i, t in enumerate(transfers):
+        queues[t.tipper].append(i)
+        queues[t.tippee].append(i)
+    is_ready = lambda i: (
+        queues[transfers[i].tipper][0] == i and queues[transfers[i].tippee][0] == i
+    )
+
+    # Start the workers
+    todo, done = Queue(), Queue()
+
+    def work():
+        while True:
+            i = todo.get()
+            if i is None:
+                return
+            try:
+                func(i, transfers[i])
+                done.put((i, None))
+            except Exception:
+                done.put((i, sys.exc_info()))
+
+    workers = [threading.Thread(target=work) for n in range(max(concurrency, 1))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    # Dispatch the transfers as soon as they're ready
+    error = None
+    try:
+        pending = 0
+        for i in range(len(transfers)):
+            if is_ready(i):
+                todo.put(i)
+                pending += 1
+        while pending:
+            i, exc_info = done.get()
+            pending -= 1
+            if exc_info:
+                error = error or exc_info
+            if error:
+                continue
+            t = transfers[i]
+            for p_id in (t.tipper, t.tippee):
+                queue = queues[p_id]
+                queue.popleft()
+                if queue and is_ready(queue[0]):
+                    todo.put(queue[0])
+                    pending += 1
+    finally:
+        for worker in workers:
+            todo.put(None)
+        for worker in workers:
+            worker.join()
+    if error:
+        reraise(*error)
 
 
 class Payday(object):
 
+    # How the donation graph is settled: 'sql' (PL/pgSQL functions and
+    # triggers) or 'python' (see `liberapay.billing.settlement`)
+    engine = 'sql'
+
+    # How many transfers can be sent to Mangopay at the same time
+    transfer_concurrency = 1
+
+    # How many transfer results are recorded per transaction
+    transfer_batch_size = 200
+
+    # How many worker processes the 'python' engine uses to settle the
+    # connected components of the donation graph
+    settlement_processes = 1
+
     @classmethod
     def start(cls):
         """Try to start a new Payday.
@@ -74,7 +161,7 @@ class Payday(object):
         payday.__dict__.update(d)
         return payday
 
-    def run(self, log_dir='.', keep_log=False, recompute_stats=10, update_cached_amounts=True):
+    def run(self, log_dir='.', keep_log=False, recompute_stats=1, update_cached_amounts=True):
         """This is the starting point for payday.
 
         It is structured such that it can be run again safely (with a
@@ -109,22 +196,20 @@ class Payday(object):
             os.rename(output_log_path+'.part', output_log_path)
 
     def shuffle(self, log_dir='.'):
-        self.transfers_filename = log_dir+'/payday-%s_transfers.pickle' % self.id
-        if os.path.exists(self.transfers_filename):
-            with open(self.transfers_filename, 'rb') as f:
-                transfers = pickle.load(f)
-            done = self.db.all("""
-                SELECT *
-                  FROM transfers t
-                 WHERE t.timestamp >= %(ts_start)s;
-            """, dict(ts_start=self.ts_start))
-            done = set((t.tipper, t.tippee, t.context, t.team) for t in done)
-            transfers = [t for t in transfers if (t.tipper, t.tippee, t.context, t.team) not in done]
+        self.transfers_filename = log_dir+'/payday-%s_transfers.journal' % self.id
+        pickle_filename = log_dir+'/payday-%s_transfers.pickle' % self.id
+        if os.path.exists(pickle_filename):
+            # This payday was started by an older version of this code
+            journal = self.convert_transfers_pickle(pickle_filename)
+        elif os.path.exists(self.transfers_filename):
+            journal = Journal(self.transfers_filename)
         else:
             with self.db.get_cursor() as cursor:
                 self.prepare(cursor, self.ts_start)
                 self.transfer_virtually(cursor, self.ts_start)
-                transfers = [NS(t._asdict()) for t in cursor.all("""
+                self.pay_invoices(cursor, self.ts_start)
+                self.check_balances(cursor)
+                cursor.execute("""
                     SELECT t.*
                          , p.mangopay_user_id AS tipper_mango_id
                          , p2.mangopay_user_id AS tippee_mango_id
@@ -133,10 +218,9 @@ class Payday(object):
                       FROM payday_transfers t
                       JOIN participants p ON p.id = t.tipper
                       JOIN participants p2 ON p2.id = t.tippee
-                """)]
-                self.check_balances(cursor)
-                with open(self.transfers_filename, 'wb') as f:
-                    pickle.dump(transfers, f)
+                  ORDER BY t.id
+                """)
+                journal = Journal.create(self.transfers_filename, cursor)
                 cursor.run("""
                     UPDATE paydays
                        SET nparticipants = (SELECT count(*) FROM payday_participants)
@@ -144,10 +228,32 @@ class Payday(object):
                 """, locals())
             self.clean_up()
 
-        self.transfer_for_real(transfers)
+        try:
+            self.transfer_for_real(journal)
+        finally:
+            journal.close()
+
+        n = merge_scheduled_cash_bundles(self.db)
+        log("Merged the cash bundles of %i participants." % n)
 
         self.db.self_check()
 
+    def convert_transfers_pickle(self, pickle_filename):
+        """Turn the transfers pickle of a crashed payday into a journal.
+        """
+        with open(pickle_filename, 'rb') as f:
+            transfers = pickle.load(f)
+        done = self.db.all("""
+            SELECT *
+              FROM transfers t
+             WHERE t.timestamp >= %(ts_start)s;
+        """, dict(ts_start=self.ts_start))
+        done = set((t.tipper, t.tippee, t.context, t.team) for t in done)
+        is_done = lambda t: (t.tipper, t.tippee, t.context, t.team) in done
+        journal = Journal.create(self.transfers_filename, transfers, is_done)
+        os.unlink(pickle_filename)
+        return journal
+
     @staticmethod
     def prepare(cursor, ts_start):
         """Prepare the DB: we need temporary tables with indexes and triggers.
@@ -164,17 +270,19 @@ class Payday(object):
                  , balance AS new_balance
                  , goal
                  , kind
+                 , row_number() OVER (ORDER BY join_time) AS ord
               FROM participants p
              WHERE join_time < %(ts_start)s
                AND (mangopay_user_id IS NOT NULL OR kind = 'group')
                AND is_suspended IS NOT true
                AND status = 'active'
-          ORDER BY join_time;
+          ORDER BY ord;
 
         CREATE UNIQUE INDEX ON payday_participants (id);
 
         CREATE TEMPORARY TABLE payday_tips ON COMMIT DROP AS
             SELECT t.id, tipper, tippee, amount, (p2.kind = 'group') AS to_team
+                 , row_number() OVER (ORDER BY p.join_time ASC, t.ctime ASC) AS ord
               FROM ( SELECT DISTINCT ON (tipper, tippee) *
                        FROM tips
                       WHERE mtime < %(ts_start)s
@@ -184,7 +292,7 @@ class Payday(object):
               JOIN payday_participants p2 ON p2.id = t.tippee
              WHERE t.amount > 0
                AND (p2.goal IS NULL or p2.goal >= 0)
-          ORDER BY p.join_time ASC, t.ctime ASC;
+          ORDER BY ord;
 
         CREATE INDEX ON payday_tips (tipper);
         CREATE INDEX ON payday_tips (tippee);
@@ -206,7 +314,8 @@ class Payday(object):
         CREATE UNIQUE INDEX ON payday_takes (team, member);
 
         CREATE TEMPORARY TABLE payday_transfers
-        ( timestamp timestamptz DEFAULT now()
+        ( id serial
+        , timestamp timestamptz DEFAULT now()
         , tipper bigint
         , tippee bigint
         , amount numeric(35,2)
@@ -293,172 +402,95 @@ class Payday(object):
         """, dict(ts_start=ts_start))
         log("Prepared the DB.")
 
-    @staticmethod
-    def transfer_virtually(cursor, ts_start):
+    @classmethod
+    def transfer_virtually(cls, cursor, ts_start):
+        if cls.engine == 'python':
+            if cls.settlement_processes > 1:
+                TipGraph.settle_in_parallel(cursor, cls.settlement_processes).save(cursor)
+            else:
+                TipGraph.load(cursor).settle().save(cursor)
+            return
         cursor.run("SELECT settle_tip_graph();")
-        teams = cursor.all("""
-            SELECT id FROM payday_participants WHERE kind = 'group';
-        """)
-        for team_id in teams:
-            Payday.resolve_takes(cursor, team_id)
+        Payday.resolve_takes(cursor)
         cursor.run("""
             SELECT settle_tip_graph();
             UPDATE payday_tips SET is_funded = false WHERE is_funded IS NULL;
         """)
-        Payday.pay_invoices(cursor, ts_start)
 
     @staticmethod
-    def resolve_takes(cursor, team_id):
+    def resolve_takes(cursor):
         """Resolve many-to-many donations (team takes)
+
+        The teams are processed in memory one after the other, then the
+        resulting transfers are inserted in bulk.
         """
-        args = dict(team_id=team_id)
-        total_income = cursor.one("""
-            WITH funded AS (
-                 UPDATE payday_tips
-                    SET is_funded = true
-                   FROM payday_participants p
-                  WHERE p.id = tipper
-                    AND tippee = %(team_id)s
-                    AND p.new_balance >= amount
-              RETURNING amount
-            )
-            SELECT COALESCE(sum(amount), 0) FROM funded;
-        """, args)
-        total_takes = cursor.one("""
-            SELECT COALESCE(sum(t.amount), 0)
-              FROM payday_takes t
-             WHERE t.team = %(team_id)s
-        """, args)
-        if total_income == 0 or total_takes == 0:
-            return
-        args['takes_ratio'] = min(total_income / total_takes, 1)
-        tips_ratio = args['tips_ratio'] = min(total_takes / total_income, 1)
-        tips = [NS(t._asdict()) for t in cursor.all("""
-            SELECT t.id, t.tipper, (round_up(t.amount * %(tips_ratio)s, 2)) AS amount
-                 , t.amount AS full_amount
-                 , COALESCE((
-                       SELECT sum(tr.amount)
-                         FROM transfers tr
-                        WHERE tr.tipper = t.tipper
-                          AND tr.team = %(team_id)s
-                          AND tr.context = 'take'
-                          AND tr.status = 'succeeded'
-                   ), 0) AS past_transfers_sum
-              FROM payday_tips t
-              JOIN payday_participants p ON p.id = t.tipper
-             WHERE t.tippee = %(team_id)s
-               AND p.new_balance >= t.amount
-        """, args)]
-        takes = [NS(t._asdict()) for t in cursor.all("""
-            SELECT t.member, (round_up(t.amount * %(takes_ratio)s, 2)) AS amount
-              FROM payday_takes t
-             WHERE t.team = %(team_id)s;
-        """, args)]
-        adjust_tips = tips_ratio != 1
-        if adjust_tips:
-            # The team has a leftover, so donation amounts can be adjusted.
-            # In the following loop we compute the "weeks" count of each tip.
-            # For example the `weeks` value is 2.5 for a donation currently at
-            # 10€/week which has distributed 25€ in the past.
-            for tip in tips:
-                tip.weeks = round_up(tip.past_transfers_sum / tip.full_amount)
-            max_weeks = max(tip.weeks for tip in tips)
-            min_weeks = min(tip.weeks for tip in tips)
-            adjust_tips = max_weeks != min_weeks
-            if adjust_tips:
-                # Some donors have given fewer weeks worth of money than others,
-                # we want to adjust the amounts so that the weeks count will
-                # eventually be the same for every donation.
-                min_tip_ratio = tips_ratio * Decimal('0.1')
-                # Loop: compute how many "weeks" each tip is behind the "oldest"
-                # tip, as well as a naive ratio and amount based on that number
-                # of weeks
-                for tip in tips:
-                    tip.weeks_to_catch_up = max_weeks - tip.weeks
-                    tip.ratio = min(min_tip_ratio + tip.weeks_to_catch_up, 1)
-                    tip.amount = round_up(tip.full_amount * tip.ratio)
-                naive_amounts_sum = sum(tip.amount for tip in tips)
-                total_to_transfer = min(total_takes, total_income)
-                delta = total_to_transfer - naive_amounts_sum
-                if delta == 0:
-                    # The sum of the naive amounts computed in the previous loop
-                    # matches the end target, we got very lucky and no further
-                    # adjustments are required
-                    adjust_tips = False
-                else:
-                    # Loop: compute the "leeway" of each tip, i.e. how much it
-                    # can be increased or decreased to fill the `delta` gap
-                    if delta < 0:
-                        # The naive amounts are too high: we want to lower the
-                        # amounts of the tips that have a "high" ratio, leaving
-                        # untouched the ones that are already low
-                        for tip in tips:
-                            if tip.ratio > min_tip_ratio:
-                                min_tip_amount = round_up(tip.full_amount * min_tip_ratio)
-                                tip.leeway = min_tip_amount - tip.amount
-                            else:
-                                tip.leeway = 0
-                    else:
-                        # The naive amounts are too low: we can raise all the
-                        # tips that aren't already at their maximum
-                        for tip in tips:
-                            tip.leeway = tip.full_amount - tip.amount
-                    leeway = sum(tip.leeway for tip in tips)
-                    leeway_ratio = min(delta / leeway, 1)
-                    tips = sorted(tips, key=lambda tip: (-tip.weeks_to_catch_up, tip.id))
-        # Loop: compute the adjusted donation amounts, and do the transfers
-        for tip in tips:
-            if adjust_tips:
-                tip_amount = round_up(tip.amount + tip.leeway * leeway_ratio)
-                if tip_amount == 0:
-                    continue
-                assert tip_amount > 0
-                assert tip_amount <= tip.full_amount
-                tip.amount = tip_amount
-            for take in takes:
-                if take.amount == 0 or tip.tipper == take.member:
-                    continue
-                transfer_amount = min(tip.amount, take.amount)
-                cursor.run("SELECT transfer(%s, %s, %s, 'take', %s, NULL)",
-                           (tip.tipper, take.member, transfer_amount, team_id))
-                tip.amount -= transfer_amount
-                take.amount -= transfer_amount
-                if tip.amount == 0:
-                    break
+        graph = TipGraph.load(cursor, teams_only=True)
+        for team in graph.teams:
+            graph.resolve_takes(team)
+        graph.save(cursor)
 
     @staticmethod
     def pay_invoices(cursor, ts_start):
         """Settle pending invoices
+
+        The invoices of each addressee are paid in the order they were
+        created, as long as the running total fits in the addressee's balance.
         """
-        invoices = cursor.all("""
-            SELECT i.*
-              FROM invoices i
-             WHERE i.status = 'accepted'
-               AND ( SELECT ie.ts
-                       FROM invoice_events ie
-                      WHERE ie.invoice = i.id
-                   ORDER BY ts DESC
-                      LIMIT 1
-                   ) < %(ts_start)s;
+        cursor.run("""
+            WITH pending AS (
+                     SELECT i.id, i.sender, i.addressee, i.amount, i.nature
+                          , sum(i.amount) OVER (
+                                PARTITION BY i.addressee ORDER BY i.id
+                            ) AS running_total
+                       FROM invoices i
+                       JOIN LATERAL (
+                                SELECT ie.ts
+                                  FROM invoice_events ie
+                                 WHERE ie.invoice = i.id
+                              ORDER BY ie.ts DESC
+                                 LIMIT 1
+                            ) last_event ON true
+                      WHERE i.status = 'accepted'
+                        AND last_event.ts < %(ts_start)s
+                 )
+               , payable AS (
+                     SELECT i.*
+                       FROM pending i
+                       JOIN payday_participants payer ON payer.id = i.addressee
+                       JOIN payday_participants payee ON payee.id = i.sender
+                      WHERE i.running_total <= payer.new_balance
+                 )
+               , new_transfers AS (
+                     INSERT INTO payday_transfers
+                                 (tipper, tippee, amount, context, invoice)
+                          SELECT addressee, sender, amount, nature::text::transfer_context, id
+                            FROM payable
+                        ORDER BY id
+                 )
+               , deltas AS (
+                     SELECT id, sum(delta) AS delta
+                       FROM ( SELECT addressee AS id, -amount AS delta FROM payable
+                              UNION ALL
+                              SELECT sender AS id, amount AS delta FROM payable
+                            ) x
+                   GROUP BY id
+                 )
+               , new_balances AS (
+                     UPDATE payday_participants p
+                        SET new_balance = p.new_balance + d.delta
+                       FROM deltas d
+                      WHERE p.id = d.id
+                 )
+               , paid AS (
+                     UPDATE invoices
+                        SET status = 'paid'
+                      WHERE id IN (SELECT id FROM payable)
+                 )
+            INSERT INTO invoice_events
+                        (invoice, participant, status)
+                 SELECT id, addressee, 'paid'
+                   FROM payable;
         """, dict(ts_start=ts_start))
-        for i in invoices:
-            payer_balance = cursor.one("""
-                SELECT p.new_balance
-                  FROM payday_participants p
-                 WHERE id = %s
-            """, (i.addressee,))
-            if payer_balance < i.amount:
-                continue
-            cursor.run("""
-                SELECT transfer(%(addressee)s, %(sender)s, %(amount)s,
-                                %(nature)s::transfer_context, NULL, %(id)s);
-                UPDATE invoices
-                   SET status = 'paid'
-                 WHERE id = %(id)s;
-                INSERT INTO invoice_events
-                            (invoice, participant, status)
-                     VALUES (%(id)s, %(addressee)s, 'paid');
-            """, i._asdict())
 
     @staticmethod
     def check_balances(cursor):
@@ -483,13 +515,96 @@ class Payday(object):
             raise NegativeBalance()
         log("Checked the balances.")
 
-    def transfer_for_real(self, transfers):
+    def transfer_for_real(self, journal):
+        """Execute the transfers of the journal that haven't been done yet.
+
+        The rows of the transfers are inserted beforehand, and the results are
+        recorded in batches of `transfer_batch_size`, one transaction each.
+        """
         db = self.db
-        print("Starting transfers (n=%i)" % len(transfers))
+        existing = dict(
+            ((t.tipper, t.tippee, t.context, t.team, t.invoice), t) for t in db.all("""
+                SELECT id, tipper, tippee, context, team, invoice, status
+                  FROM transfers
+                 WHERE timestamp >= %s
+            """, (self.ts_start,))
+        )
+        indexes, transfers, missing = [], [], []
+        for i, state, t in journal.read():
+            t = NS(t)
+            row = existing.get((t.tipper, t.tippee, t.context, t.team, t.invoice))
+            if row and (state == STARTED or row.status != 'pre'):
+                # This transfer was attempted before the previous run crashed
+                journal.mark_done(i)
+                continue
+            if row:
+                # This transfer was inserted before the previous run crashed
+                t.id = row.id
+            else:
+                missing.append(t)
+            indexes.append(i)
+            transfers.append(t)
+        self.insert_transfers(missing)
+        n, concurrency = len(transfers), self.transfer_concurrency
+        print("Starting transfers (n=%i, concurrency=%i)" % (n, concurrency))
         msg = "Executing transfer #%i (amount=%s context=%s team=%s tipper_wallet_id=%s tippee_wallet_id=%s)"
-        for i, t in enumerate(transfers):
+        lock = threading.Lock()
+        batch = []
+
+        def flush():
+            # Must be called with `lock` held
+            done = batch[:]
+            del batch[:]
+            record_transfer_results(db, [r for i, r in done])
+            for i, r in done:
+                journal.mark_done(i)
+
+        def f(i, t):
+            i = indexes[i]
             log(msg % (i, t.amount, t.context, t.team, t.tipper_wallet_id, t.tippee_wallet_id))
-            transfer(db, **t.__dict__)
+            journal.mark_started(i)
+            kw = dict(t.__dict__)
+            status, error = get_transfer_result(send_transfer(db, kw.pop('id'), **kw))
+            with lock:
+                batch.append((i, (t.id, status, error)))
+                if status == 'failed' or len(batch) >= self.transfer_batch_size:
+                    flush()
+            if status == 'failed':
+                raise TransferError(error)
+
+        start = time.time()
+        try:
+            execute_transfers(transfers, f, concurrency)
+        finally:
+            with lock:
+                flush()
+        delta = time.time() - start
+        if n:
+            log("Executed %i transfers in %.2f seconds (%.1f transfers per second)." %
+                (n, delta, n / delta if delta else float('inf')))
+
+    def insert_transfers(self, transfers):
+        """Insert the `transfers` into the `transfers` table with the status
+        `pre`, and set their `id` attributes.
+        """
+        if not transfers:
+            return
+        with self.db.get_cursor() as cursor:
+            ids = cursor.all("""
+                SELECT nextval('transfers_id_seq') FROM generate_series(1, %s)
+            """, (len(transfers),))
+            f = io.StringIO()
+            for t_id, t in zip(ids, transfers):
+                t.id = t_id
+                f.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\tpre\n' % (
+                    t_id, t.tipper, t.tippee, t.amount, t.context,
+                    '\\N' if t.team is None else t.team,
+                    '\\N' if t.invoice is None else t.invoice,
+                ))
+            f.seek(0)
+            cursor.copy_from(f, 'transfers', columns=(
+                'id', 'tipper', 'tippee', 'amount', 'context', 'team', 'invoice', 'status'
+            ))
 
     def clean_up(self):
         self.db.run("""
@@ -499,7 +614,10 @@ class Payday(object):
         """)
 
     @classmethod
-    def update_stats(cls, payday_id):
+    def compute_stats(cls, payday_id):
+        """Compute the stats of a payday from the `transfers`, `exchanges` and
+        `participants` tables.
+        """
         ts_start, ts_end = cls.db.one("""
             SELECT ts_start, ts_end FROM paydays WHERE id = %s
         """, (payday_id,))
@@ -512,7 +630,7 @@ class Payday(object):
         else:
             previous_ts_start = constants.EPOCH
         assert previous_ts_start
-        cls.db.run("""\
+        return cls.db.one("""\
 
             WITH our_transfers AS (
                      SELECT *
@@ -544,73 +662,96 @@ class Payday(object):
                         AND e.timestamp >= %(previous_ts_start)s
                         AND status <> 'failed'
                  )
-            UPDATE paydays
-               SET nactive = (
+            SELECT (
                        SELECT DISTINCT count(*) FROM (
                            SELECT tipper FROM our_transfers
                                UNION
                            SELECT tippee FROM our_transfers
                        ) AS foo
-                   )
-                 , ntippers = (SELECT count(DISTINCT tipper) FROM our_transfers)
-                 , ntippees = (SELECT count(DISTINCT tippee) FROM our_transfers)
-                 , ntips = (SELECT count(*) FROM our_tips)
-                 , ntakes = (SELECT count(*) FROM our_takes)
-                 , take_volume = (SELECT COALESCE(sum(amount), 0) FROM our_takes)
-                 , ntransfers = (SELECT count(*) FROM our_transfers)
-                 , transfer_volume = (SELECT COALESCE(sum(amount), 0) FROM our_transfers)
-                 , transfer_volume_refunded = (
-                       SELECT COALESCE(sum(amount), 0)
-                         FROM our_transfers
-                        WHERE refund_ref IS NOT NULL
-                   )
-                 , nusers = (
-                       SELECT count(*)
-                         FROM participants p
-                        WHERE p.kind IN ('individual', 'organization')
-                          AND p.join_time < %(ts_start)s
-                          AND COALESCE((
-                                SELECT payload::text
-                                  FROM events e
-                                 WHERE e.participant = p.id
-                                   AND e.type = 'set_status'
-                                   AND e.ts < %(ts_start)s
-                              ORDER BY ts DESC
-                                 LIMIT 1
-                              ), '') <> '"closed"'
-                   )
-                 , week_deposits = (
-                       SELECT COALESCE(sum(amount), 0)
-                         FROM week_exchanges
-                        WHERE amount > 0
-                          AND refund_ref IS NULL
-                          AND status = 'succeeded'
-                   )
-                 , week_deposits_refunded = (
-                       SELECT COALESCE(sum(amount), 0)
-                         FROM week_exchanges
-                        WHERE amount > 0
-                          AND refunded
-                   )
-                 , week_withdrawals = (
-                       SELECT COALESCE(-sum(amount), 0)
-                         FROM week_exchanges
-                        WHERE amount < 0
-                          AND refund_ref IS NULL
-                   )
-                 , week_withdrawals_refunded = (
-                       SELECT COALESCE(sum(amount), 0)
-                         FROM week_exchanges
-                        WHERE amount < 0
-                          AND refunded
-                   )
-             WHERE id = %(payday_id)s
+                   ) AS nactive
+                 , (SELECT count(DISTINCT tipper) FROM our_transfers) AS ntippers
+                 , (SELECT count(DISTINCT tippee) FROM our_transfers) AS ntippees
+                 , (SELECT count(*) FROM our_tips) AS ntips
+                 , (SELECT count(*) FROM our_takes) AS ntakes
+                 , (SELECT COALESCE(sum(amount), 0) FROM our_takes) AS take_volume
+                 , (SELECT count(*) FROM our_transfers) AS ntransfers
+                 , (SELECT COALESCE(sum(amount), 0) FROM our_transfers) AS transfer_volume
+                 , ( SELECT COALESCE(sum(amount), 0)
+                       FROM our_transfers
+                      WHERE refund_ref IS NOT NULL
+                   ) AS transfer_volume_refunded
+                 , ( SELECT count(*)
+                       FROM participants p
+                      WHERE p.kind IN ('individual', 'organization')
+                        AND p.join_time < %(ts_start)s
+                        AND COALESCE((
+                              SELECT payload::text
+                                FROM events e
+                               WHERE e.participant = p.id
+                                 AND e.type = 'set_status'
+                                 AND e.ts < %(ts_start)s
+                            ORDER BY ts DESC
+                               LIMIT 1
+                            ), '') <> '"closed"'
+                   ) AS nusers
+                 , ( SELECT COALESCE(sum(amount), 0)
+                       FROM week_exchanges
+                      WHERE amount > 0
+                        AND refund_ref IS NULL
+                        AND status = 'succeeded'
+                   ) AS week_deposits
+                 , ( SELECT COALESCE(sum(amount), 0)
+                       FROM week_exchanges
+                      WHERE amount > 0
+                        AND refunded
+                   ) AS week_deposits_refunded
+                 , ( SELECT COALESCE(-sum(amount), 0)
+                       FROM week_exchanges
+                      WHERE amount < 0
+                        AND refund_ref IS NULL
+                   ) AS week_withdrawals
+                 , ( SELECT COALESCE(sum(amount), 0)
+                       FROM week_exchanges
+                      WHERE amount < 0
+                        AND refunded
+                   ) AS week_withdrawals_refunded
+
+        """, locals(), back_as=dict)
 
-        """, locals())
+    @classmethod
+    def update_stats(cls, payday_id, verify=False):
+        """Recompute the stats of a payday.
+
+        In `verify` mode the `paydays` row is only updated if the stored stats
+        don't match the recomputed ones.
+        """
+        stats = cls.compute_stats(payday_id)
+        if verify:
+            stored = cls.db.one("""
+                SELECT {0} FROM paydays WHERE id = %s
+            """.format(', '.join(stats)), (payday_id,), back_as=dict)
+            mismatches = sorted(k for k, v in stats.items() if stored[k] != v)
+            if not mismatches:
+                return
+            log("The stats of payday #%i were out of date (%s)." %
+                (payday_id, ', '.join(mismatches)))
+        cls.db.run("""
+            UPDATE paydays
+               SET {0}
+             WHERE id = %(payday_id)s
+        """.format(', '.join('{0} = %({0})s'.format(k) for k in stats)),
+                   dict(stats, payday_id=payday_id))
         log("Updated stats of payday #%i." % payday_id)
 
     @classmethod
-    def recompute_stats(cls, limit=None):
+    def recompute_stats(cls, limit=None, verify=False):
+        """Recompute the stats of the last `limit` paydays.
+
+        Once a payday has ended, the triggers on the `exchanges` and
+        `transfers` tables keep its stats up to date, so this is only needed
+        for the payday that just ended, and to check the older ones in
+        `verify` mode.
+        """
         ids = cls.db.all("""
             SELECT id
               FROM paydays
@@ -619,95 +760,120 @@ class Payday(object):
              LIMIT %s
         """, (limit,))
         for payday_id in ids:
-            cls.update_stats(payday_id)
+            cls.update_stats(payday_id, verify=verify)
 
     def update_cached_amounts(self):
+        """Update the `giving`, `taking`, `receiving` and `npatrons` columns.
+
+        The payday tables are aggregated once per column, and only the
+        participants that appear in the aggregates or whose cached value isn't
+        zero are looked at.
+        """
         now = pando.utils.utcnow()
         with self.db.get_cursor() as cursor:
             self.prepare(cursor, now)
             self.transfer_virtually(cursor, now)
-            cursor.run("""
+            for what, sql in self.UPDATE_CACHED_AMOUNTS_QUERIES:
+                start = time.time()
+                cursor.execute(sql)
+                log("Updated %s of %i rows in %.2f seconds." %
+                    (what, cursor.rowcount, time.time() - start))
+        self.clean_up()
+        log("Updated receiving amounts.")
 
+    UPDATE_CACHED_AMOUNTS_QUERIES = (
+        ('tips.is_funded', """
             UPDATE tips t
                SET is_funded = t2.is_funded
               FROM payday_tips t2
              WHERE t.id = t2.id
                AND t.is_funded <> t2.is_funded;
-
+        """),
+        ('participants.giving', """
             UPDATE participants p
                SET giving = p2.giving
-              FROM ( SELECT p2.id
-                          , COALESCE((
-                                SELECT sum(amount)
-                                  FROM payday_tips t
-                                 WHERE t.tipper = p2.id
-                                   AND t.is_funded
-                            ), 0) AS giving
+              FROM ( SELECT p2.id, COALESCE(t.giving, 0) AS giving
                        FROM participants p2
+                  LEFT JOIN ( SELECT tipper, sum(amount) AS giving
+                                FROM payday_tips
+                               WHERE is_funded
+                            GROUP BY tipper
+                            ) t ON t.tipper = p2.id
+                      WHERE t.tipper IS NOT NULL
+                         OR p2.giving <> 0
                    ) p2
              WHERE p.id = p2.id
                AND p.giving <> p2.giving;
-
+        """),
+        ('participants.taking', """
             UPDATE participants p
                SET taking = p2.taking
-              FROM ( SELECT p2.id
-                          , COALESCE((
-                                SELECT sum(amount)
-                                  FROM payday_transfers t
-                                 WHERE t.tippee = p2.id
-                                   AND context = 'take'
-                            ), 0) AS taking
+              FROM ( SELECT p2.id, COALESCE(t.taking, 0) AS taking
                        FROM participants p2
+                  LEFT JOIN ( SELECT tippee, sum(amount) AS taking
+                                FROM payday_transfers
+                               WHERE context = 'take'
+                            GROUP BY tippee
+                            ) t ON t.tippee = p2.id
+                      WHERE t.tippee IS NOT NULL
+                         OR p2.taking <> 0
                    ) p2
              WHERE p.id = p2.id
                AND p.taking <> p2.taking;
-
+        """),
+        ('participants.receiving', """
             UPDATE participants p
                SET receiving = p2.receiving
-              FROM ( SELECT p2.id
-                          , p2.taking + COALESCE((
-                                SELECT sum(amount)
-                                  FROM payday_tips t
-                                 WHERE t.tippee = p2.id
-                                   AND t.is_funded
-                            ), 0) AS receiving
+              FROM ( SELECT p2.id, p2.taking + COALESCE(t.receiving, 0) AS receiving
                        FROM participants p2
+                  LEFT JOIN ( SELECT tippee, sum(amount) AS receiving
+                                FROM payday_tips
+                               WHERE is_funded
+                            GROUP BY tippee
+                            ) t ON t.tippee = p2.id
+                      WHERE t.tippee IS NOT NULL
+                         OR p2.taking <> 0
+                         OR p2.receiving <> 0
                    ) p2
              WHERE p.id = p2.id
                AND p.receiving <> p2.receiving
                AND p.status <> 'stub';
-
+        """),
+        ('participants.npatrons (individuals and organizations)', """
             UPDATE participants p
                SET npatrons = p2.npatrons
-              FROM ( SELECT p2.id
-                          , ( SELECT count(*)
-                                FROM payday_transfers t
-                               WHERE t.tippee = p2.id
-                            ) AS npatrons
+              FROM ( SELECT p2.id, COALESCE(t.npatrons, 0) AS npatrons
                        FROM participants p2
+                  LEFT JOIN ( SELECT tippee, count(*) AS npatrons
+                                FROM payday_transfers
+                            GROUP BY tippee
+                            ) t ON t.tippee = p2.id
+                      WHERE t.tippee IS NOT NULL
+                         OR p2.npatrons <> 0
                    ) p2
              WHERE p.id = p2.id
                AND p.npatrons <> p2.npatrons
                AND p.status <> 'stub'
                AND p.kind IN ('individual', 'organization');
-
+        """),
+        ('participants.npatrons (teams)', """
             UPDATE participants p
                SET npatrons = p2.npatrons
-              FROM ( SELECT p2.id
-                          , ( SELECT count(*)
-                                FROM payday_tips t
-                               WHERE t.tippee = p2.id
-                                 AND t.is_funded
-                            ) AS npatrons
+              FROM ( SELECT p2.id, COALESCE(t.npatrons, 0) AS npatrons
                        FROM participants p2
+                  LEFT JOIN ( SELECT tippee, count(*) AS npatrons
+                                FROM payday_tips
+                               WHERE is_funded
+                            GROUP BY tippee
+                            ) t ON t.tippee = p2.id
+                      WHERE t.tippee IS NOT NULL
+                         OR p2.npatrons <> 0
                    ) p2
              WHERE p.id = p2.id
                AND p.npatrons <> p2.npatrons
                AND p.kind = 'group';
-
-            """)
-        self.clean_up()
-        log("Updated receiving amounts.")
+        """),
+    )
 
     def end(self):
         self.ts_end = self.db.one("""
@@ -728,33 +894,38 @@ class Payday(object):
 
         # Income notifications
         r = self.db.all("""
-            SELECT tippee, json_agg(t) AS transfers
+            SELECT t.tippee, p.balance, json_agg(t) AS transfers
               FROM transfers t
-             WHERE "timestamp" > %s
-               AND "timestamp" <= %s
-               AND context NOT IN ('refund', 'expense')
-          GROUP BY tippee
+              JOIN participants p ON p.id = t.tippee
+             WHERE t."timestamp" > %s
+               AND t."timestamp" <= %s
+               AND t.context NOT IN ('refund', 'expense')
+          GROUP BY t.tippee, p.balance
         """, (previous_ts_end, self.ts_end))
-        for tippee_id, transfers in r:
+        team_ids = set(t['team'] for _, _, transfers in r for t in transfers if t['team'])
+        team_names = dict(self.db.all("""
+            SELECT id, username FROM participants WHERE id = ANY(%s)
+        """, (list(team_ids),)))
+        notifications = []
+        for tippee_id, balance, transfers in r:
             successes = [t for t in transfers if t['status'] == 'succeeded']
             if not successes:
                 continue
             by_team = {k: sum(t['amount'] for t in v)
                        for k, v in group_by(successes, 'team').items()}
             personal = by_team.pop(None, 0)
-            by_team = {Participant.from_id(k).username: v for k, v in by_team.items()}
-            p = Participant.from_id(tippee_id)
-            p.notify(
-                'income',
+            by_team = {team_names[k]: v for k, v in by_team.items()}
+            notifications.append((tippee_id, 'income', dict(
                 total=sum(t['amount'] for t in successes),
                 personal=personal,
                 by_team=by_team,
-                new_balance=p.balance,
-            )
+                new_balance=balance,
+            )))
+        Participant.notify_many(notifications)
 
         # Identity-required notifications
         participants = self.db.all("""
-            SELECT p.*::participants
+            SELECT p.id
               FROM participants p
              WHERE mangopay_user_id IS NULL
                AND kind IN ('individual', 'organization')
@@ -768,12 +939,14 @@ class Payday(object):
                         AND p2.balance > t.amount
                    )
         """)
-        for p in participants:
-            p.notify('identity_required', force_email=True)
+        Participant.notify_many(
+            ((p_id, 'identity_required', {}) for p_id in participants),
+            force_email=True,
+        )
 
         # Low-balance notifications
         participants = self.db.all("""
-            SELECT p.*::participants
+            SELECT p.id, p.balance
               FROM participants p
              WHERE balance < (
                      SELECT sum(amount)
@@ -793,8 +966,95 @@ class Payday(object):
                         AND t.status = 'succeeded'
                    )
         """, (previous_ts_end, self.ts_end))
-        for p in participants:
-            p.notify('low_balance', low_balance=p.balance)
+        Participant.notify_many(
+            (p.id, 'low_balance', dict(low_balance=p.balance)) for p in participants
+        )
+
+
+def simulate(db):
+    """Run the virtual part of a payday and measure it, then roll it back.
+
+    The `prepare`, `transfer_virtually`, `pay_invoices`, `check_balances` and
+    `update_cached_amounts` phases are executed in a single transaction which
+    is never committed, and nothing is sent to Mangopay.
+
+    Returns a list of dicts, one per phase, containing the wall time and the
+    time spent waiting for the database (in seconds), the number of
+    statements, the number of rows inserted, updated or deleted, the number of
+    transfers added to `payday_transfers`, the number of calls to the
+    `transfer()` SQL function (`None` if `track_functions` is off), and the
+    peak memory usage of the process (in kilobytes).
+    """
+    report = []
+    ts_start = pando.utils.utcnow()
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        stats = dict(db_time=0.0, statements=0)
+
+        def timed(f):
+            def g(*a, **kw):
+                start = time.time()
+                try:
+                    return f(*a, **kw)
+                finally:
+                    stats['db_time'] += time.time() - start
+                    stats['statements'] += 1
+            return g
+
+        execute, copy_from = cursor.execute, cursor.copy_from
+        track_functions = cursor.one("SELECT current_setting('track_functions')") != 'none'
+
+        def counters():
+            execute("""
+                SELECT ( SELECT COALESCE(sum(n_tup_ins + n_tup_upd + n_tup_del), 0)
+                           FROM pg_stat_xact_all_tables
+                       ) AS rows_touched
+                     , ( SELECT COALESCE(sum(calls), 0)
+                           FROM pg_stat_xact_user_functions
+                          WHERE funcname = 'transfer'
+                       ) AS transfer_calls
+                     , ( SELECT to_regclass('payday_transfers') IS NOT NULL ) AS has_transfers
+            """)
+            rows_touched, transfer_calls, has_transfers = cursor.fetchone()
+            n_transfers = 0
+            if has_transfers:
+                execute("SELECT count(*) FROM payday_transfers")
+                n_transfers = cursor.fetchone()[0]
+            return rows_touched, transfer_calls, n_transfers
+
+        def cached_amounts(cursor):
+            for what, sql in Payday.UPDATE_CACHED_AMOUNTS_QUERIES:
+                cursor.execute(sql)
+
+        phases = (
+            ('prepare', lambda c: Payday.prepare(c, ts_start)),
+            ('transfer_virtually', lambda c: Payday.transfer_virtually(c, ts_start)),
+            ('pay_invoices', lambda c: Payday.pay_invoices(c, ts_start)),
+            ('check_balances', Payday.check_balances),
+            ('update_cached_amounts', cached_amounts),
+        )
+        cursor.execute, cursor.copy_from = timed(execute), timed(copy_from)
+        try:
+            for name, phase in phases:
+                stats.update(db_time=0.0, statements=0)
+                before = counters()
+                start = time.time()
+                phase(cursor)
+                wall_time = time.time() - start
+                after = counters()
+                report.append(dict(
+                    phase=name,
+                    wall_time=round(wall_time, 3),
+                    db_time=round(stats['db_time'], 3),
+                    statements=stats['statements'],
+                    rows_touched=int(after[0] - before[0]),
+                    transfers=int(after[2] - before[2]),
+                    transfer_calls=int(after[1] - before[1]) if track_functions else None,
+                    peak_memory=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                ))
+        finally:
+            conn.rollback()
+    return report
 
 
 def main(override_payday_checks=False):
@@ -824,7 +1084,7 @@ def main(override_payday_checks=False):
     assert lock, "failed to acquire the payday lock"
 
     try:
-        sync_with_mangopay(website.db)
+        sync_with_mangopay(website.db, Payday.transfer_concurrency)
         Payday.start().run(website.env.log_dir, website.env.keep_payday_logs)
     except KeyboardInterrupt:  # pragma: no cover
         pass
@@ -836,4 +1096,11 @@ def main(override_payday_checks=False):
 
 
 if __name__ == '__main__':  # pragma: no cover
-    main()
+    if sys.argv[1:] == ['--simulate']:
+        import json
+        from liberapay.main import website
+        # Use the module configured by `wireup`, not `__main__`
+        from liberapay.billing import payday
+        print(json.dumps(payday.simulate(website.db), indent=4))
+    else:
+        main()
@@ -0,0 +1,435 @@
+"""Settle the payday donation graph in Python instead of PL/pgSQL.
+
+`Payday.prepare` creates a `process_tip` trigger and a `settle_tip_graph()`
+function which fund the tips one row at a time. The `TipGraph` class below
+loads the `payday_*` tables once, runs the same algorithm in memory, and writes
+the results back in a few bulk statements. The SQL path also uses it, through
+`Payday.resolve_takes`, to split the income of the teams among their members.
+
+The results are the same as the SQL path's, including the order in which the
+tips are processed. The `payday_participants` and `payday_tips` tables have an
+`ord` column which is filled when they're created, and their rows are inserted
+in that order, which is the order in which the SQL `UPDATE` statements scan
+them. `TipGraph.load` sorts the rows by that column instead of relying on the
+physical order of the tables. Team donations are split in the order of their
+IDs.
+"""
+from __future__ import division, print_function, unicode_literals
+
+from collections import defaultdict, OrderedDict
+from decimal import Decimal, localcontext, ROUND_UP
+import heapq
+import io
+import multiprocessing
+
+from liberapay.constants import D_CENT, D_ZERO
+
+
+log = print
+
+
+def round_up(d):
+    return d.quantize(D_CENT, rounding=ROUND_UP)
+
+
+class NS(object):
+    def __init__(self, d):
+        self.__dict__.update(d)
+
+
+def split_team_income(tips, takes, tips_ratio, total_income, total_takes):
+    """Compute how a team's income is distributed among its members.
+
+    `tips` and `takes` are lists of `NS` objects, their `amount` attributes
+    must already have been multiplied by the tips and takes ratios. Returns
+    a list of `(tipper, member, amount)` tuples.
+    """
+    adjust_tips = tips_ratio != 1
+    if adjust_tips:
+        # The team has a leftover, so donation amounts can be adjusted.
+        # In the following loop we compute the "weeks" count of each tip.
+        # For example the `weeks` value is 2.5 for a donation currently at
+        # 10€/week which has distributed 25€ in the past.
+        for tip in tips:
+            tip.weeks = round_up(tip.past_transfers_sum / tip.full_amount)
+        max_weeks = max(tip.weeks for tip in tips)
+        min_weeks = min(tip.weeks for tip in tips)
+        adjust_tips = max_weeks != min_weeks
+        if adjust_tips:
+            # Some donors have given fewer weeks worth of money than others,
+            # we want to adjust the amounts so that the weeks count will
+            # eventually be the same for every donation.
+            min_tip_ratio = tips_ratio * Decimal('0.1')
+            # Loop: compute how many "weeks" each tip is behind the "oldest"
+            # tip, as well as a naive ratio and amount based on that number
+            # of weeks
+            for tip in tips:
+                tip.weeks_to_catch_up = max_weeks - tip.weeks
+                tip.ratio = min(min_tip_ratio + tip.weeks_to_catch_up, 1)
+                tip.amount = round_up(tip.full_amount * tip.ratio)
+            naive_amounts_sum = sum(tip.amount for tip in tips)
+            total_to_transfer = min(total_takes, total_income)
+            delta = total_to_transfer - naive_amounts_sum
+            if delta == 0:
+                # The sum of the naive amounts computed in the previous loop
+                # matches the end target, we got very lucky and no further
+                # adjustments are required
+                adjust_tips = False
+            else:
+                # Loop: compute the "leeway" of each tip, i.e. how much it
+                # can be increased or decreased to fill the `delta` gap
+                if delta < 0:
+                    # The naive amounts are too high: we want to lower the
+                    # amounts of the tips that have a "high" ratio, leaving
+                    # untouched the ones that are already low
+                    for tip in tips:
+                        if tip.ratio > min_tip_ratio:
+                            min_tip_amount = round_up(tip.full_amount * min_tip_ratio)
+                            tip.leeway = min_tip_amount - tip.amount
+                        else:
+                            tip.leeway = 0
+                else:
+                    # The naive amounts are too low: we can raise all the
+                    # tips that aren't already at their maximum
+                    for tip in tips:
+                        tip.leeway = tip.full_amount - tip.amount
+                leeway = sum(tip.leeway for tip in tips)
+                leeway_ratio = min(delta / leeway, 1)
+                tips = sorted(tips, key=lambda tip: (-tip.weeks_to_catch_up, tip.id))
+    # Loop: compute the adjusted donation amounts, and the transfers
+    transfers = []
+    for tip in tips:
+        if adjust_tips:
+            tip_amount = round_up(tip.amount + tip.leeway * leeway_ratio)
+            if tip_amount == 0:
+                continue
+            assert tip_amount > 0
+            assert tip_amount <= tip.full_amount
+            tip.amount = tip_amount
+        for take in takes:
+            if take.amount == 0 or tip.tipper == take.member:
+                continue
+            transfer_amount = min(tip.amount, take.amount)
+            transfers.append((tip.tipper, take.member, transfer_amount))
+            tip.amount -= transfer_amount
+            take.amount -= transfer_amount
+            if tip.amount == 0:
+                break
+    return transfers
+
+
+def split_components(participants, tips, takes, past_transfers):
+    """Partition the rows of the payday tables into the connected components
+    of the donation graph.
+
+    Returns a list of `(participants, tips, takes, past_transfers)` tuples,
+    in the order of the components' first participants. The rows keep their
+    original order. The components which don't contain any tip are left out.
+    """
+    parents = {}
+
+    def find(p_id):
+        root = p_id
+        while parents[root] != root:
+            root = parents[root]
+        while parents[p_id] != root:
+            parents[p_id], p_id = root, parents[p_id]
+        return root
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parents[b] = a
+
+    for p_id, balance, kind in participants:
+        parents[p_id] = p_id
+    for t_id, tipper, tippee, amount, to_team, is_funded in tips:
+        union(tipper, tippee)
+    for team, member, amount in takes:
+        union(team, member)
+    # The rows are converted to plain tuples so that they can be pickled
+    components = OrderedDict()
+    for p in participants:
+        components.setdefault(find(p[0]), ([], [], [], {}))[0].append(tuple(p))
+    for t in tips:
+        c = components[find(t[1])]
+        c[1].append(tuple(t))
+        if (t[1], t[2]) in past_transfers:
+            c[3][(t[1], t[2])] = past_transfers[(t[1], t[2])]
+    for take in takes:
+        components[find(take[0])][2].append(tuple(take))
+    return [c for c in components.values() if c[1]]
+
+
+def settle_component(rows):
+    """Settle one component of the graph, in a worker process.
+
+    Returns the transfers and the changed `is_funded` values, with the IDs of
+    the participants and tips instead of their positions.
+    """
+    graph = TipGraph(*rows).settle()
+    p_ids = graph.p_ids
+    transfers = [(p_ids[tipper], p_ids[tippee], amount, context, team)
+                 for tipper, tippee, amount, context, team in graph.transfers]
+    funded = [(graph.t_ids[pos], is_funded) for pos, is_funded in enumerate(graph.t_funded)
+              if is_funded != graph.old_funded[pos]]
+    return transfers, funded
+
+
+class TipGraph(object):
+    """An in-memory copy of the `payday_participants`, `payday_tips` and
+    `payday_takes` tables.
+
+    Participants and tips are stored in parallel lists, tips reference
+    participants by their position in those lists.
+    """
+
+    MAX_ITERATIONS = 50  # same limit as the `settle_tip_graph()` SQL function
+
+    def __init__(self, participants, tips, takes, past_transfers):
+        # Participants
+        self.p_ids = []
+        self.p_balances = []
+        self.teams = []
+        self.index = {}
+        for p_id, balance, kind in participants:
+            i = self.index[p_id] = len(self.p_ids)
+            self.p_ids.append(p_id)
+            self.p_balances.append(balance)
+            if kind == 'group':
+                self.teams.append(i)
+        self.old_balances = list(self.p_balances)
+        # Tips
+        self.t_ids = []
+        self.t_tippers = []
+        self.t_tippees = []
+        self.t_amounts = []
+        self.t_funded = []
+        self.tips_by_tipper = defaultdict(list)  # one-to-one donations only
+        self.tips_by_team = defaultdict(list)
+        index = self.index
+        for t_id, tipper, tippee, amount, to_team, is_funded in tips:
+            pos = len(self.t_ids)
+            self.t_ids.append(t_id)
+            self.t_tippers.append(index[tipper])
+            self.t_tippees.append(index[tippee])
+            self.t_amounts.append(amount)
+            self.t_funded.append(is_funded)
+            if to_team:
+                self.tips_by_team[index[tippee]].append(pos)
+            else:
+                self.tips_by_tipper[index[tipper]].append(pos)
+        # Takes, ordered by member
+        self.takes_by_team = defaultdict(list)
+        for team, member, amount in takes:
+            self.takes_by_team[index[team]].append((index[member], amount))
+        # Sums of the past take transfers, keyed by (tipper, team) ids
+        self.past_transfers = past_transfers
+        self.old_funded = list(self.t_funded)
+        # The tips that need to be (re)examined by the next settlement pass
+        self.stale = set(
+            pos for l in self.tips_by_tipper.values() for pos in l
+            if not self.t_funded[pos]
+        )
+        # The transfers we've made, in order
+        self.transfers = []
+
+    @classmethod
+    def load(cls, cursor, teams_only=False):
+        """Read the payday tables.
+
+        If `teams_only` is true then the one-to-one donations are left out.
+        """
+        return cls(*cls.fetch(cursor, teams_only))
+
+    @staticmethod
+    def fetch(cursor, teams_only=False):
+        """Return the `(participants, tips, takes, past_transfers)` rows
+        that the constructor expects.
+        """
+        participants = cursor.all("""
+            SELECT id, new_balance, kind FROM payday_participants ORDER BY ord
+        """)
+        tips = cursor.all("""
+            SELECT id, tipper, tippee, amount, to_team, is_funded
+              FROM payday_tips
+             WHERE to_team OR NOT %s
+          ORDER BY ord
+        """, (teams_only,))
+        takes = cursor.all("""
+            SELECT team, member, amount FROM payday_takes ORDER BY team, member
+        """)
+        past_transfers = dict(((tipper, team), amount) for tipper, team, amount in cursor.all("""
+            SELECT tt.tipper, tt.team, tt.amount
+              FROM take_totals tt
+              JOIN payday_tips t ON t.tipper = tt.tipper AND t.tippee = tt.team
+        """))
+        return participants, tips, takes, past_transfers
+
+    @classmethod
+    def settle_in_parallel(cls, cursor, processes):
+        """Settle the connected components of the graph in `processes` worker
+        processes, and merge the results.
+
+        Money can't flow from one component to another, so settling them
+        separately gives the same results as settling the whole graph. The
+        transfers are merged in the order of the components' first
+        participants, and the relative order of the transfers of each
+        component is preserved.
+        """
+        rows = cls.fetch(cursor)
+        graph = cls(*rows)
+        components = split_components(*rows)
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(settle_component, components)
+        finally:
+            pool.terminate()
+        index, t_index = graph.index, dict((t_id, pos) for pos, t_id in enumerate(graph.t_ids))
+        for transfers, funded in results:
+            for tipper, tippee, amount, context, team in transfers:
+                graph.transfer(index[tipper], index[tippee], amount, context, team)
+            for t_id, is_funded in funded:
+                graph.t_funded[t_index[t_id]] = is_funded
+        log("Settled %i components of the tip graph in %i processes." %
+            (len(components), processes))
+        return graph
+
+    def transfer(self, tipper, tippee, amount, context, team=None):
+        """Move money between two participants, like the `transfer()` SQL function.
+        """
+        if amount == 0:
+            return
+        self.p_balances[tipper] -= amount
+        self.p_balances[tippee] += amount
+        self.transfers.append((tipper, tippee, amount, context, team))
+
+    def settle(self):
+        """Settle the whole graph, like `Payday.transfer_virtually` (except for
+        invoices).
+        """
+        self.settle_tips()
+        for team in self.teams:
+            self.resolve_takes(team)
+        self.settle_tips()
+        t_funded = self.t_funded
+        for pos, is_funded in enumerate(t_funded):
+            if is_funded is None:
+                t_funded[pos] = False
+        return self
+
+    def settle_tips(self):
+        """Fund one-to-one donations, like the `settle_tip_graph()` SQL function.
+
+        The SQL function loops over the unfunded tips until it can't fund any
+        more of them. A tip can only become fundable after its tipper has
+        received money, so in each pass we only look at the tips whose tipper
+        has been credited since the last time we examined them, in the same
+        order as the SQL function.
+        """
+        balances, amounts = self.p_balances, self.t_amounts
+        tippers, tippees, t_funded = self.t_tippers, self.t_tippees, self.t_funded
+        tips_by_tipper = self.tips_by_tipper
+        i = 0
+        while True:
+            i += 1
+            queue = sorted(self.stale)
+            queued = self.stale
+            self.stale = set()
+            count = 0
+            while queue:
+                pos = heapq.heappop(queue)
+                tipper = tippers[pos]
+                if amounts[pos] > balances[tipper]:
+                    continue
+                tippee = tippees[pos]
+                self.transfer(tipper, tippee, amounts[pos], 'tip')
+                t_funded[pos] = True
+                count += 1
+                # The tippee's unfunded tips need to be examined again, in this
+                # pass if we haven't reached them yet, in the next one otherwise
+                for pos2 in tips_by_tipper.get(tippee, ()):
+                    if t_funded[pos2]:
+                        continue
+                    if pos2 > pos:
+                        if pos2 not in queued:
+                            heapq.heappush(queue, pos2)
+                            queued.add(pos2)
+                    else:
+                        self.stale.add(pos2)
+            if count == 0:
+                break
+            if i > self.MAX_ITERATIONS:
+                raise Exception('Reached the maximum number of iterations')
+
+    def resolve_takes(self, team):
+        """Resolve the team's many-to-many donations, like `Payday.resolve_takes`.
+        """
+        balances, amounts, tippers = self.p_balances, self.t_amounts, self.t_tippers
+        tips = [pos for pos in self.tips_by_team.get(team, ())
+                if balances[tippers[pos]] >= amounts[pos]]
+        tips.sort(key=self.t_ids.__getitem__)
+        for pos in tips:
+            self.t_funded[pos] = True
+        total_income = sum((amounts[pos] for pos in tips), D_ZERO)
+        takes = self.takes_by_team.get(team, ())
+        total_takes = sum((amount for member, amount in takes), D_ZERO)
+        if total_income == 0 or total_takes == 0:
+            return
+        takes_ratio = min(total_income / total_takes, 1)
+        tips_ratio = min(total_takes / total_income, 1)
+        team_id = self.p_ids[team]
+        # Same precision as PostgreSQL's numeric multiplication
+        with localcontext() as ctx:
+            ctx.prec = 100
+            tips = [NS(dict(
+                id=self.t_ids[pos],
+                tipper=tippers[pos],
+                amount=round_up(amounts[pos] * tips_ratio),
+                full_amount=amounts[pos],
+                past_transfers_sum=self.past_transfers.get(
+                    (self.p_ids[tippers[pos]], team_id), D_ZERO
+                ),
+            )) for pos in tips]
+            takes = [NS(dict(member=member, amount=round_up(amount * takes_ratio)))
+                     for member, amount in takes]
+        transfers = split_team_income(
+            tips, takes, tips_ratio, total_income, total_takes
+        )
+        for tipper, member, amount in transfers:
+            self.transfer(tipper, member, amount, 'take', team_id)
+            self.stale.update(pos for pos in self.tips_by_tipper.get(member, ())
+                              if not self.t_funded[pos])
+
+    def save(self, cursor):
+        """Write the results of the settlement into the payday tables.
+        """
+        p_ids = self.p_ids
+        f = io.StringIO()
+        for tipper, tippee, amount, context, team in self.transfers:
+            team = '\\N' if team is None else str(team)
+            f.write('%s\t%s\t%s\t%s\t%s\n' % (p_ids[tipper], p_ids[tippee], amount, context, team))
+        f.seek(0)
+        cursor.copy_from(f, 'payday_transfers', columns=(
+            'tipper', 'tippee', 'amount', 'context', 'team'
+        ))
+        changed = [i for i, balance in enumerate(self.p_balances)
+                   if balance != self.old_balances[i]]
+        cursor.run("""
+            UPDATE payday_participants p
+               SET new_balance = x.new_balance
+              FROM unnest(%s::bigint[], %s::numeric[]) x (id, new_balance)
+             WHERE p.id = x.id;
+        """, ([p_ids[i] for i in changed], [self.p_balances[i] for i in changed]))
+        changed = [pos for pos, is_funded in enumerate(self.t_funded)
+                   if is_funded != self.old_funded[pos]]
+        # The `process_tip` trigger would redo the transfers
+        cursor.run("""
+            ALTER TABLE payday_tips DISABLE TRIGGER process_tip;
+            UPDATE payday_tips t
+               SET is_funded = x.is_funded
+              FROM unnest(%s::int[], %s::boolean[]) x (id, is_funded)
+             WHERE t.id = x.id;
+            ALTER TABLE payday_tips ENABLE TRIGGER process_tip;
+        """, ([self.t_ids[pos] for pos in changed], [self.t_funded[pos] for pos in changed]))
+        log("Settled the tip graph in Python (%i transfers)." % len(self.transfers))
@@ -15,6 +15,7 @@ from pando.algorithms.website import fill_response_with_output
 from pando.utils import maybe_encode
 
 from liberapay import utils, wireup
+from liberapay.billing.exchanges import merge_scheduled_cash_bundles
 from liberapay.cron import Cron
 from liberapay.models.community import Community
 from liberapay.models.participant import Participant
@@ -23,7 +24,7 @@ from liberapay.utils import b64decode_s, b64encode_s, erase_cookie, http_caching
 from liberapay.utils.state_chain import (
     create_response_object, canonize, insert_constants, _dispatch_path_to_filesystem,
     merge_exception_into_response, return_500_for_exception, turn_socket_error_into_50X,
-    overwrite_status_code_of_gateway_errors,
+    overwrite_status_code_of_gateway_errors, start_identity_map, stop_identity_map,
 )
 from liberapay.renderers import csv_dump, jinja2, jinja2_jswrapped, jinja2_xml_min, scss
 from liberapay.website import website
@@ -91,6 +92,7 @@ if env.run_cron_jobs and conf:
     cron(conf.check_db_every, website.db.self_check, True)
     cron(conf.dequeue_emails_every, Participant.dequeue_emails, True)
     cron(conf.send_newsletters_every, Participant.send_newsletters, True)
+    cron(conf.merge_cash_bundles_every, lambda: merge_scheduled_cash_bundles(website.db), True)
 
 
 # Website Algorithm
@@ -112,6 +114,7 @@ algorithm.functions = [
     csrf.extract_token_from_cookie,
     csrf.reject_forgeries,
     authentication.authenticate_user_if_possible,
+    start_identity_map,
 
     _dispatch_path_to_filesystem,
     algorithm['handle_dispatch_exception'],
@@ -139,6 +142,7 @@ algorithm.functions = [
     return_500_for_exception,
 
     overwrite_status_code_of_gateway_errors,
+    stop_identity_map,
 
     tell_sentry,
 ]
@@ -40,6 +40,7 @@ def check_db(cursor):
     _check_bundles_against_balances(cursor)
     _check_bundles_grouped_by_origin_against_exchanges(cursor)
     _check_bundles_grouped_by_withdrawal_against_exchanges(cursor)
+    _check_take_totals_against_transfers(cursor)
 
 
 def _check_tips(cursor):
@@ -193,6 +194,27 @@ def _check_bundles_grouped_by_withdrawal_against_exchanges(cursor):
     assert len(l) == 0, "bundles are out of whack:\n" + '\n'.join(str(r) for r in l)
 
 
+def _check_take_totals_against_transfers(cursor):
+    """Check that the `take_totals` table is coherent with the transfers.
+    """
+    l = cursor.all("""
+        SELECT COALESCE(tt.tipper, tr.tipper) AS tipper
+             , COALESCE(tt.team, tr.team) AS team
+             , COALESCE(tt.amount, 0) AS total_found
+             , COALESCE(tr.amount, 0) AS total_expected
+          FROM take_totals tt
+     FULL JOIN (
+                  SELECT tipper, team, sum(amount) AS amount
+                    FROM transfers
+                   WHERE context = 'take'
+                     AND status = 'succeeded'
+                GROUP BY tipper, team
+               ) tr ON tr.tipper = tt.tipper AND tr.team = tt.team
+         WHERE COALESCE(tt.amount, 0) <> COALESCE(tr.amount, 0)
+    """)
+    assert len(l) == 0, "take totals are out of whack:\n" + '\n'.join(str(r) for r in l)
+
+
 def run_migrations(db):
     v = 0
     db_meta = db.one("SELECT to_regclass('db_meta')")
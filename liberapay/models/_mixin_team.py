@@ -15,6 +15,26 @@ class MemberLimitReached(Exception): pass
 class InactiveParticipantAdded(Exception): pass
 
 
+def distribute_takes(balance, nominal_takes):
+    """Compute the actual amounts of a team's takes, and return an OrderedDict.
+
+    The dicts in `nominal_takes` are modified in place.
+    """
+    actual_takes = OrderedDict()
+    total_takes = sum(t['amount'] for t in nominal_takes if t['is_identified'])
+    ratio = min(balance / total_takes, 1) if total_takes else 0
+    for take in nominal_takes:
+        nominal = take['nominal_take'] = take.pop('amount')
+        actual = take['actual_amount'] = min(
+            (nominal * ratio).quantize(D_CENT, rounding=ROUND_UP),
+            balance
+        ) if take['is_identified'] else D_ZERO
+        balance -= actual
+        actual_takes[take['member_id']] = take
+    actual_takes.leftover = balance
+    return actual_takes
+
+
 class MixinTeam(object):
 
     def invite(self, invitee, inviter):
@@ -182,36 +202,31 @@ class MixinTeam(object):
         """Return a list of member takes for a team.
         """
         assert self.kind == 'group'
-        TAKES = """
-            SELECT p.id AS member_id, p.username AS member_name, p.avatar_url
+        return self.get_current_takes_of_teams([self.id], cursor=cursor)[self.id]
+
+    @classmethod
+    def get_current_takes_of_teams(cls, team_ids, cursor=None):
+        """Return the member takes of several teams, as a `{team_id: [take]}` dict.
+        """
+        records = (cursor or cls.db).all("""
+            SELECT t.team, p.id AS member_id, p.username AS member_name, p.avatar_url
                  , (p.mangopay_user_id IS NOT NULL) AS is_identified
                  , t.amount, t.ctime, t.mtime
               FROM current_takes t
               JOIN participants p ON p.id = member
-             WHERE t.team=%(team)s
-          ORDER BY p.username
-        """
-        records = (cursor or self.db).all(TAKES, dict(team=self.id))
-        return [r._asdict() for r in records]
+             WHERE t.team = ANY(%s)
+          ORDER BY t.team, p.username
+        """, (list(team_ids),))
+        takes = {team_id: [] for team_id in team_ids}
+        for r in records:
+            take = r._asdict()
+            takes[take.pop('team')].append(take)
+        return takes
 
     def compute_actual_takes(self, cursor=None):
         """Get the takes, compute the actual amounts, and return an OrderedDict.
         """
-        actual_takes = OrderedDict()
-        nominal_takes = self.get_current_takes(cursor=cursor)
-        balance = self.receiving
-        total_takes = sum(t['amount'] for t in nominal_takes if t['is_identified'])
-        ratio = min(balance / total_takes, 1) if total_takes else 0
-        for take in nominal_takes:
-            nominal = take['nominal_take'] = take.pop('amount')
-            actual = take['actual_amount'] = min(
-                (nominal * ratio).quantize(D_CENT, rounding=ROUND_UP),
-                balance
-            ) if take['is_identified'] else D_ZERO
-            balance -= actual
-            actual_takes[take['member_id']] = take
-        actual_takes.leftover = balance
-        return actual_takes
+        return distribute_takes(self.receiving, self.get_current_takes(cursor=cursor))
 
     @property
     def nmembers(self):
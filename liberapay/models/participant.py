@@ -1,11 +1,13 @@
 from __future__ import print_function, unicode_literals
 
 from base64 import b64decode, b64encode
+from collections import defaultdict
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
 from email.utils import formataddr
 from hashlib import pbkdf2_hmac, md5
 from os import urandom
 from time import sleep
+import threading
 import uuid
 
 from six.moves.urllib.parse import quote, urlencode
@@ -44,7 +46,7 @@ from liberapay.exceptions import (
     UsernameIsRestricted,
     UsernameTooLong,
 )
-from liberapay.models._mixin_team import MixinTeam
+from liberapay.models._mixin_team import distribute_takes, MixinTeam
 from liberapay.models.account_elsewhere import AccountElsewhere
 from liberapay.models.community import Community
 from liberapay.models.exchange_route import ExchangeRoute
@@ -56,6 +58,41 @@ from liberapay.utils import (
 from liberapay.website import website
 
 
+identity_maps = threading.local()
+
+
+class IdentityMap(object):
+    """Keeps the participants loaded during a request, so that each one is
+    only fetched once.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_username = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, p):
+        self.by_id[p.id] = p
+        if p.username:
+            self.by_username[p.username.lower()] = p
+        return p
+
+    def get(self, thing, value):
+        if thing == 'id':
+            try:
+                p = self.by_id.get(int(value))
+            except ValueError:
+                p = None
+        else:
+            p = self.by_username.get(value)
+        if p is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return p
+
+
 class Participant(Model, MixinTeam):
 
     typname = 'participants'
@@ -149,13 +186,42 @@ class Participant(Model, MixinTeam):
         """
         return cls._from_thing("lower(username)", username.lower())
 
+    @classmethod
+    def from_ids(cls, ids):
+        """Return a dict of the existing participants among the given ids.
+
+        The participants that aren't in the identity map are fetched in one
+        query.
+        """
+        identity_map = getattr(identity_maps, 'current', None)
+        r, missing = {}, []
+        for id in set(ids):
+            p = identity_map.get('id', id) if identity_map else None
+            if p is None:
+                missing.append(id)
+            else:
+                r[p.id] = p
+        if missing:
+            for p in cls.db.all("""
+                SELECT p
+                  FROM participants p
+                 WHERE id = ANY(%s)
+            """, (missing,)):
+                r[p.id] = identity_map.add(p) if identity_map else p
+        return r
+
     @classmethod
     def _from_thing(cls, thing, value):
         assert thing in ("id", "lower(username)", "mangopay_user_id", "lower(email)")
+        identity_map = getattr(identity_maps, 'current', None)
+        if identity_map and thing in ("id", "lower(username)"):
+            p = identity_map.get(thing, value)
+            if p is not None:
+                return p
         if thing == 'lower(email)':
             # This query looks for an unverified address if the participant
             # doesn't have any verified address
-            return cls.db.one("""
+            p = cls.db.one("""
                 SELECT p.*::participants
                   FROM emails e
                   JOIN participants p ON p.id = e.participant
@@ -164,11 +230,27 @@ class Participant(Model, MixinTeam):
               ORDER BY p.email NULLS LAST, p.id ASC
                  LIMIT 1
             """, (value,))
-        return cls.db.one("""
-            SELECT participants.*::participants
-              FROM participants
-             WHERE {}=%s
-        """.format(thing), (value,))
+        else:
+            p = cls.db.one("""
+                SELECT participants.*::participants
+                  FROM participants
+                 WHERE {}=%s
+            """.format(thing), (value,))
+        if identity_map and p:
+            identity_map.add(p)
+        return p
+
+    @staticmethod
+    def start_identity_map():
+        """Cache the participants loaded by the current thread until
+        `stop_identity_map` is called.
+        """
+        identity_maps.current = IdentityMap()
+        return identity_maps.current
+
+    @staticmethod
+    def stop_identity_map():
+        return identity_maps.__dict__.pop('current', None)
 
     @classmethod
     def authenticate(cls, k1, k2, v1=None, v2=None):
@@ -200,7 +282,15 @@ class Participant(Model, MixinTeam):
                 return p
 
     def refetch(self):
-        return self._from_thing('id', self.id)
+        p = self.db.one("""
+            SELECT participants.*::participants
+              FROM participants
+             WHERE id=%s
+        """, (self.id,))
+        identity_map = getattr(identity_maps, 'current', None)
+        if identity_map and p:
+            identity_map.add(p)
+        return p
 
 
     # Password Management
@@ -421,6 +511,7 @@ class Participant(Model, MixinTeam):
         transfers = []
         distributed = D_ZERO
 
+        teams = Participant.from_ids(t.tippee for t in tips if t.kind == 'group')
         for tip in tips:
             rate = tip.amount / total
             pro_rated = (self.balance * rate).quantize(D_CENT, ROUND_DOWN)
@@ -428,7 +519,7 @@ class Participant(Model, MixinTeam):
                 continue
             if tip.kind == 'group':
                 team_id = tip.tippee
-                team = Participant.from_id(team_id)
+                team = teams[team_id]
                 takes = [
                     t for t in team.get_current_takes(cursor=cursor)
                     if t['is_identified'] and t['amount'] and t['member_id'] != self.id
@@ -813,6 +904,54 @@ class Participant(Model, MixinTeam):
         if web:
             return self.add_notification(event, **context)
 
+    @classmethod
+    def notify_many(cls, notifications, force_email=False, web=True):
+        """Send notifications to many participants at once.
+
+        `notifications` is an iterable of `(participant_id, event, context)`
+        tuples. The emails, the web notifications and the `pending_notifs`
+        counters are written in three statements, regardless of the number
+        of recipients.
+        """
+        p_ids, events, bits, contexts = [], [], [], []
+        for p_id, event, context in notifications:
+            p_ids.append(p_id)
+            events.append(event)
+            bits.append(0 if force_email else EVENTS.get(event).bit)
+            contexts.append(serialize(context))
+        if not p_ids:
+            return
+        with cls.db.get_cursor() as cursor:
+            cursor.run("""
+                INSERT INTO email_queue
+                            (participant, spt_name, context)
+                     SELECT x.participant, x.event, x.context
+                       FROM unnest(%(p_ids)s::bigint[], %(events)s::text[], %(bits)s::int[],
+                                   %(contexts)s::bytea[])
+                            WITH ORDINALITY x (participant, event, bit, context, i)
+                       JOIN participants p ON p.id = x.participant
+                      WHERE %(force_email)s OR p.email_notif_bits & x.bit <> 0
+                   ORDER BY x.i;
+            """, locals())
+            if not web:
+                return
+            cursor.run("""
+                INSERT INTO notification_queue
+                            (participant, event, context)
+                     SELECT x.participant, x.event, x.context
+                       FROM unnest(%(p_ids)s::bigint[], %(events)s::text[], %(contexts)s::bytea[])
+                            WITH ORDINALITY x (participant, event, context, i)
+                   ORDER BY x.i;
+
+                UPDATE participants p
+                   SET pending_notifs = pending_notifs + x.n
+                  FROM ( SELECT participant, count(*) AS n
+                           FROM unnest(%(p_ids)s::bigint[]) participant
+                       GROUP BY participant
+                       ) x
+                 WHERE p.id = x.participant;
+            """, locals())
+
     def add_notification(self, event, **context):
         p_id = self.id
         context = serialize(context)
@@ -926,8 +1065,9 @@ class Participant(Model, MixinTeam):
         return r
 
     def notify_patrons(self, elsewhere, tips):
+        tippers = Participant.from_ids(t.tipper for t in tips)
         for t in tips:
-            Participant.from_id(t.tipper).notify(
+            tippers[t.tipper].notify(
                 'pledgee_joined',
                 user_name=elsewhere.user_name,
                 platform=elsewhere.platform_data.display_name,
@@ -1331,8 +1471,7 @@ class Participant(Model, MixinTeam):
 
     def update_giving_and_tippees(self, cursor):
         updated_tips = self.update_giving(cursor)
-        for tip in updated_tips:
-            Participant.from_id(tip.tippee).update_receiving(cursor)
+        self.update_receiving_many([tip.tippee for tip in updated_tips], cursor)
 
     def update_giving(self, cursor=None):
         # Update is_funded on tips
@@ -1345,21 +1484,26 @@ class Participant(Model, MixinTeam):
           ORDER BY p2.join_time IS NULL, t.ctime ASC
         """, (self.id,))
         fake_balance = self.balance + self.receiving
-        updated = []
+        changed = []
         for tip in tips:
             if tip.amount > fake_balance:
                 is_funded = False
             else:
                 fake_balance -= tip.amount
                 is_funded = True
-            if tip.is_funded == is_funded:
-                continue
-            updated.append((cursor or self.db).one("""
-                UPDATE tips
-                   SET is_funded = %s
-                 WHERE id = %s
-             RETURNING *
-            """, (is_funded, tip.id)))
+            if tip.is_funded != is_funded:
+                changed.append((tip.id, is_funded))
+        updated = []
+        if changed:
+            updated = (cursor or self.db).all("""
+                UPDATE tips t
+                   SET is_funded = x.is_funded
+                  FROM unnest(%s::int[], %s::boolean[]) x (id, is_funded)
+                 WHERE t.id = x.id
+             RETURNING t.*
+            """, tuple(map(list, zip(*changed))))
+            order = {t_id: i for i, (t_id, is_funded) in enumerate(changed)}
+            updated.sort(key=lambda tip: order[tip.id])
 
         # Update giving on participant
         giving = (cursor or self.db).one("""
@@ -1382,29 +1526,68 @@ class Participant(Model, MixinTeam):
         return updated
 
     def update_receiving(self, cursor=None):
-        if self.kind == 'group':
-            old_takes = self.compute_actual_takes(cursor=cursor)
-        r = (cursor or self.db).one("""
+        r = self.update_receiving_many([self.id], cursor)[self.id]
+        self.set_attributes(receiving=r.receiving, npatrons=r.npatrons)
+
+    @classmethod
+    def update_receiving_many(cls, p_ids, cursor=None):
+        """Recompute the `receiving` and `npatrons` of several participants.
+
+        The takes of the teams among them are updated accordingly. Returns a
+        dict of `(receiving, npatrons)` records keyed by participant ID.
+        """
+        p_ids = sorted(set(p_ids))
+        if not p_ids:
+            return {}
+        db = cursor or cls.db
+        teams = dict(db.all("""
+            SELECT id, receiving
+              FROM participants
+             WHERE id = ANY(%s)
+               AND kind = 'group'
+        """, (p_ids,)))
+        nominal_takes = cls.get_current_takes_of_teams(teams, cursor) if teams else {}
+        old_takes = {
+            team_id: distribute_takes(receiving, [dict(t) for t in nominal_takes[team_id]])
+            for team_id, receiving in teams.items()
+        }
+        r = {x.id: x for x in db.all("""
             WITH our_tips AS (
-                     SELECT amount
+                     SELECT tippee, sum(amount) AS amount, count(*) AS npatrons
                        FROM current_tips
-                      WHERE tippee = %(id)s
+                      WHERE tippee = ANY(%(p_ids)s)
                         AND amount > 0
                         AND is_funded
+                   GROUP BY tippee
                  )
             UPDATE participants p
-               SET receiving = (COALESCE((
-                       SELECT sum(amount)
-                         FROM our_tips
-                   ), 0) + taking)
-                 , npatrons = COALESCE((SELECT count(*) FROM our_tips), 0)
-             WHERE p.id = %(id)s
-         RETURNING receiving, npatrons
-        """, dict(id=self.id))
-        self.set_attributes(receiving=r.receiving, npatrons=r.npatrons)
-        if self.kind == 'group':
-            new_takes = self.compute_actual_takes(cursor=cursor)
-            self.update_taking(old_takes, new_takes, cursor=cursor)
+               SET receiving = (COALESCE(t.amount, 0) + taking)
+                 , npatrons = COALESCE(t.npatrons, 0)
+              FROM unnest(%(p_ids)s::bigint[]) x (id)
+         LEFT JOIN our_tips t ON t.tippee = x.id
+             WHERE p.id = x.id
+         RETURNING p.id, p.receiving, p.npatrons
+        """, dict(p_ids=p_ids))}
+        if not teams:
+            return r
+        diffs = defaultdict(lambda: D_ZERO)
+        for team_id, old in old_takes.items():
+            new = distribute_takes(r[team_id].receiving, nominal_takes[team_id])
+            for m_id, take in new.items():
+                diffs[m_id] += take['actual_amount'] - old[m_id]['actual_amount']
+        diffs = [(m_id, diff) for m_id, diff in sorted(diffs.items()) if diff != 0]
+        if diffs:
+            db.run("""
+                UPDATE participants p
+                   SET taking = (taking + x.diff)
+                     , receiving = (receiving + x.diff)
+                  FROM unnest(%s::bigint[], %s::numeric[]) x (id, diff)
+                 WHERE p.id = x.id
+            """, tuple(map(list, zip(*diffs))))
+            for m_id, diff in diffs:
+                if m_id in r:
+                    r[m_id] = r[m_id]._replace(receiving=r[m_id].receiving + diff)
+        return r
 
 
     def set_tip_to(self, tippee, periodic_amount, period='weekly',
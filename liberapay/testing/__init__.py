@@ -148,6 +148,7 @@ class Harness(unittest.TestCase):
                 self.tablenames.insert(0, tablename)
         self.db.run("ALTER SEQUENCE participants_id_seq RESTART WITH 1")
         self.db.run("ALTER SEQUENCE paydays_id_seq RESTART WITH 1")
+        exchanges.forget_mango_ids()
 
 
     def make_elsewhere(self, platform, user_id, user_name, domain='', **kw):
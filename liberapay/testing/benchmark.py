@@ -0,0 +1,101 @@
+"""Time the payday at several scales.
+
+Usage: python -m liberapay.testing.benchmark [num_participants ...]
+
+For each scale point the database is emptied, filled by
+`fake_data.populate_db_in_bulk`, then a payday is run with fake Mangopay
+transfers, and the durations of `Payday.shuffle`, `Payday.update_stats`,
+`Payday.update_cached_amounts` and `Payday.notify_participants` are measured.
+
+The database is wiped, so this must only be run against a throwaway one, e.g.
+the tests database (`make benchmark`). The results are printed and appended to
+the `benchmarks.jsonl` file, one JSON object per scale point, along with the
+current git commit, so that they can be compared over time.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from datetime import datetime
+import json
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock
+
+from liberapay.billing.payday import Payday
+from liberapay.testing.mangopay import fake_transfer
+from liberapay.utils.fake_data import populate_db_in_bulk
+
+
+DEFAULT_SCALES = (1000, 10000, 100000)
+RESULTS_FILE = 'benchmarks.jsonl'
+
+
+def measure(f, rounds=1):
+    durations = []
+    for i in range(rounds):
+        start = time.time()
+        f()
+        durations.append(time.time() - start)
+    return dict(
+        rounds=rounds,
+        min=round(min(durations), 3),
+        max=round(max(durations), 3),
+        mean=round(sum(durations) / rounds, 3),
+    )
+
+
+def wipe(db):
+    tables = db.all("""
+        SELECT tablename
+          FROM pg_tables
+         WHERE schemaname='public'
+           AND tablename NOT IN ('db_meta', 'app_conf')
+    """)
+    db.run("TRUNCATE {0} RESTART IDENTITY CASCADE".format(', '.join(tables)))
+
+
+def run_scale_point(db, num_participants, rounds=3):
+    wipe(db)
+    counts = populate_db_in_bulk(
+        db, num_participants=num_participants, num_teams=num_participants // 20, seed=0,
+    )
+    payday = Payday.start()
+    results = {}
+    log_dir = tempfile.mkdtemp()
+    with mock.patch('mangopay.resources.Transfer.save', autospec=True) as save:
+        save.side_effect = fake_transfer
+        results['shuffle'] = measure(lambda: payday.shuffle(log_dir))
+    payday.end()
+    results['update_stats'] = measure(lambda: Payday.update_stats(payday.id), rounds)
+    results['update_cached_amounts'] = measure(payday.update_cached_amounts, rounds)
+    results['notify_participants'] = measure(payday.notify_participants)
+    return dict(counts=counts, results=results)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(scales):
+    from liberapay.main import website
+    commit = git_commit()
+    for num_participants in scales:
+        r = run_scale_point(website.db, num_participants)
+        r.update(
+            date=datetime.utcnow().isoformat(),
+            commit=commit,
+            engine=Payday.engine,
+            scale=num_participants,
+        )
+        print(json.dumps(r, indent=4, sort_keys=True))
+        with open(RESULTS_FILE, 'a') as f:
+            f.write(json.dumps(r, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or DEFAULT_SCALES)
@@ -1,11 +1,14 @@
 import datetime
 from decimal import Decimal as D
+import io
 import random
 import string
 import sys
 
 from faker import Factory
+from pando.utils import utcnow
 from psycopg2 import IntegrityError
+from six import text_type
 
 from liberapay.billing.exchanges import record_exchange_result, _record_transfer_result
 from liberapay.constants import D_CENT, DONATION_LIMITS, PERIOD_CONVERSION_RATES
@@ -79,8 +82,8 @@ def fake_community(db, creator):
     return c
 
 
-def random_money_amount(min_amount, max_amount):
-    amount = D(random.random()) * (max_amount - min_amount) + min_amount
+def random_money_amount(min_amount, max_amount, rng=random):
+    amount = D(rng.random()) * (max_amount - min_amount) + min_amount
     return amount.quantize(D_CENT)
 
 
@@ -267,6 +270,140 @@ def populate_db(website, num_participants=100, num_tips=200, num_teams=5, num_tr
     print("")
 
 
+def _reserve_ids(cursor, sequence, n):
+    """Take `n` consecutive values from a sequence.
+    """
+    first = cursor.one("SELECT nextval(%s)", (sequence,))
+    cursor.run("SELECT setval(%s, %s)", (sequence, first + n - 1))
+    return range(first, first + n)
+
+
+def _copy(cursor, table, columns, rows, chunk_size=100000):
+    """Insert rows into a table with COPY, one chunk at a time.
+    """
+    f = io.StringIO()
+    n = 0
+    for row in rows:
+        f.write('\t'.join('\\N' if v is None else text_type(v) for v in row))
+        f.write('\n')
+        n += 1
+        if n % chunk_size == 0:
+            f.seek(0)
+            cursor.copy_from(f, table, columns=columns)
+            f = io.StringIO()
+    f.seek(0)
+    cursor.copy_from(f, table, columns=columns)
+    return n
+
+
+def populate_db_in_bulk(
+    db, num_participants=1000, num_teams=10, donors_ratio=0.3, team_tips_ratio=0.1,
+    tips_per_donor=lambda rng: min(int(rng.paretovariate(1.2)), 100),
+    team_size=lambda rng: min(int(rng.paretovariate(1.5)), 50),
+    take_amount=lambda rng: rng.choice((None, D('0.00'), D('1.00'), random_money_amount(1, 100, rng))),
+    weeks_of_balance=lambda rng: rng.choice((0, 1, 2, 4, 52)),
+    seed=None,
+):
+    """Populate the DB with a large donation graph, using COPY.
+
+    Unlike `populate_db`, this doesn't create elsewhere accounts, communities
+    or past transfers, only what payday needs: participants, teams with their
+    takes, tips, and the exchanges and cash bundles that fund the donors.
+
+    The distributions are callables which receive a `random.Random` object:
+    `tips_per_donor` returns the number of tips of a donor, `team_size` the
+    number of members of a team, `take_amount` the take of a member, and
+    `weeks_of_balance` how many weeks of donations a donor can fund.
+
+    Returns a dict of counts.
+    """
+    rng = random.Random(seed)
+    now = utcnow()
+    year = datetime.timedelta(days=365)
+    random_ts = lambda start, end: start + datetime.timedelta(
+        seconds=(end - start).total_seconds() * rng.random()
+    )
+    min_amount, max_amount = DONATION_LIMITS['weekly']
+    counts = {}
+    with db.get_cursor() as cursor:
+        ids = _reserve_ids(cursor, 'participants_id_seq', num_participants + num_teams)
+        individuals, teams = ids[:num_participants], ids[num_participants:]
+        join_times = {p_id: random_ts(now - year, now - year / 12) for p_id in ids}
+        counts['participants'] = _copy(cursor, 'participants', (
+            'id', 'username', 'kind', 'status', 'join_time', 'password',
+            'mangopay_user_id', 'mangopay_wallet_id',
+        ), [
+            (p_id, 'fake-%i' % p_id, 'individual', 'active', join_times[p_id], 'x',
+             'fake-%i' % p_id, '-1')
+            for p_id in individuals
+        ] + [
+            (p_id, 'fake-team-%i' % p_id, 'group', 'active', join_times[p_id], None,
+             None, None)
+            for p_id in teams
+        ])
+
+        # Takes
+        takes = []
+        for team in teams:
+            members = rng.sample(individuals, min(max(team_size(rng), 1), len(individuals)))
+            for member in members:
+                ctime = random_ts(max(join_times[team], join_times[member]), now)
+                takes.append((ctime, ctime, member, team, take_amount(rng), member))
+        counts['takes'] = _copy(cursor, 'takes', (
+            'ctime', 'mtime', 'member', 'team', 'amount', 'recorder',
+        ), takes)
+
+        # Tips
+        donors = rng.sample(individuals, int(num_participants * donors_ratio))
+        tips, balances = [], {}
+        for tipper in donors:
+            n = min(tips_per_donor(rng), num_participants - 1)
+            tippees = set()
+            while len(tippees) < n:
+                pool = teams if teams and rng.random() < team_tips_ratio else individuals
+                tippee = rng.choice(pool)
+                if tippee != tipper:
+                    tippees.add(tippee)
+            total = 0
+            for tippee in tippees:
+                amount = random_money_amount(min_amount, max_amount, rng)
+                ctime = random_ts(max(join_times[tipper], join_times[tippee]), now)
+                mtime = random_ts(ctime, now)
+                tips.append((ctime, mtime, tipper, tippee, amount, 'weekly', amount))
+                total += amount
+            balance = total * weeks_of_balance(rng)
+            if balance:
+                balances[tipper] = balance
+        counts['tips'] = _copy(cursor, 'tips', (
+            'ctime', 'mtime', 'tipper', 'tippee', 'amount', 'period', 'periodic_amount',
+        ), tips)
+
+        # Exchanges and cash bundles
+        route_ids = _reserve_ids(cursor, 'exchange_routes_id_seq', len(balances))
+        e_ids = _reserve_ids(cursor, 'exchanges_id_seq', len(balances))
+        funded = list(zip(sorted(balances), route_ids, e_ids))
+        _copy(cursor, 'exchange_routes', (
+            'id', 'participant', 'network', 'address', 'error', 'one_off',
+        ), [(r_id, p_id, 'mango-cc', '-1', '', False) for p_id, r_id, e_id in funded])
+        timestamps = {p_id: random_ts(join_times[p_id], now - year / 52) for p_id in balances}
+        counts['exchanges'] = _copy(cursor, 'exchanges', (
+            'id', 'timestamp', 'amount', 'fee', 'vat', 'participant', 'status', 'route',
+        ), [
+            (e_id, timestamps[p_id], balances[p_id], 0, 0, p_id, 'succeeded', r_id)
+            for p_id, r_id, e_id in funded
+        ])
+        _copy(cursor, 'cash_bundles', ('owner', 'origin', 'amount', 'ts'), [
+            (p_id, e_id, balances[p_id], timestamps[p_id]) for p_id, r_id, e_id in funded
+        ])
+        cursor.run("""
+            UPDATE participants p
+               SET balance = x.balance
+              FROM unnest(%s::bigint[], %s::numeric[]) x (id, balance)
+             WHERE p.id = x.id
+        """, (list(balances), list(balances.values())))
+    return counts
+
+
 def main():
     from liberapay.main import website
     populate_db(website)
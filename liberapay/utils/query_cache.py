@@ -1,7 +1,19 @@
+from collections import namedtuple, OrderedDict
+import fcntl
+import hashlib
+import heapq
+import itertools
+import os
+import select
 import sys
+import tempfile
 import threading
 import time
 import traceback
+import weakref
+
+import psycopg2
+from six.moves import cPickle as pickle
 
 
 # Define a query cache.
@@ -19,6 +31,9 @@ class Entry(object):
     timestamp = None    # The timestamp of the last query run [datetime.datetime]
     lock = None         # Access control for this record [threading.Lock]
     exc = None          # Any exception in query or formatting [Exception]
+    size = 0            # The estimated memory footprint of the entry [bytes]
+    refreshing = False  # Whether a background refresh is pending [bool]
+    started = 0         # When the last query run started [timestamp]
 
     def __init__(self, timestamp=0, lock=None, result=None):
         """Populate with dummy data or an actual db entry.
@@ -28,6 +43,323 @@ class Entry(object):
         self.result = result
 
 
+def estimate_size(obj, depth=3):
+    """Estimate the memory footprint of an object, in bytes.
+
+    Containers are only explored `depth` levels deep.
+    """
+    size = sys.getsizeof(obj)
+    if depth == 0:
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += estimate_size(k, depth - 1) + estimate_size(v, depth - 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += estimate_size(v, depth - 1)
+    return size
+
+
+class Shard(object):
+    """A part of a QueryCache, with its own lock and its own limits.
+
+    The entries are kept in least recently used order. Their expiry times are
+    kept in a heap, so that pruning only has to look at the expired entries.
+    """
+
+    def __init__(self, max_entries=None, max_size=None, max_age=60):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.max_age = max_age
+        self.cache = OrderedDict()
+        self.expiries = []  # a heap of (expiry time, sequence number, key, entry)
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.shared_hits = 0
+        self.evictions = 0
+        self.lock_waits = 0
+
+    def acquire(self):
+        """Acquire the shard's lock, and count the times we have to wait for it.
+        """
+        if not self.lock.acquire(False):
+            self.lock.acquire()
+            self.lock_waits += 1
+
+    def count(self, counter):
+        self.acquire()
+        setattr(self, counter, getattr(self, counter) + 1)
+        self.lock.release()
+
+    def serve(self, key, threshold, stale_ttl, invalidated_at=0):
+        """Return the cached result for `key` without waiting for the entry's lock.
+
+        Returns `None` if there isn't a result that can be served, otherwise a
+        `(result, refresh)` tuple, `refresh` is true when the result is stale
+        and the caller has to start refreshing it. Cached exceptions and
+        results of queries started before `invalidated_at` are never served
+        from here.
+        """
+        self.acquire()
+        try:  # critical section
+            now = time.time()
+            if self.expiries and self.expiries[0][0] <= now:
+                self.prune(now)
+            entry = self.cache.get(key)
+            if entry is None or not entry.timestamp or entry.exc is not None:
+                return
+            if entry.started < invalidated_at:
+                return
+            age = now - entry.timestamp
+            if age < threshold:
+                self.hits += 1
+                refresh = False
+            elif age < threshold + stale_ttl:
+                self.stale_hits += 1
+                refresh = not entry.refreshing
+                entry.refreshing = True
+            else:
+                return
+            # Move the entry to the end, it's the most recently used now
+            self.cache[key] = self.cache.pop(key)
+            return entry.result, refresh
+        finally:
+            self.lock.release()
+
+    def checkout(self, key):
+        """Return the entry for `key`, with its lock acquired.
+
+        If the query isn't in the cache yet, a dummy entry is added for it
+        (which prevents other threads from running the same query), and will be
+        populated presently.
+        """
+        self.acquire()
+        try:  # critical section
+            entry = self.cache.pop(key, None)
+            if entry is None:
+                entry = Entry()
+            # Move the entry to the end, it's the most recently used now
+            self.cache[key] = entry
+        finally:
+            self.lock.release()
+        # The entry's lock is acquired outside of the shard's critical
+        # section, so that a slow query doesn't block the other ones
+        if not entry.lock.acquire(False):
+            entry.lock.acquire()
+            self.acquire()
+            self.lock_waits += 1
+            self.lock.release()
+        return entry
+
+    def checkin(self, key, entry, result, exc, counter='misses', timestamp=None,
+                started=None):
+        """Store the new result of a checked out entry.
+        """
+        self.acquire()
+        try:  # critical section
+            setattr(self, counter, getattr(self, counter) + 1)
+            entry.result = result
+            entry.exc = exc
+            size = estimate_size(key) + estimate_size(result)
+            other = self.cache.get(key)
+            if other is not None and other is not entry:
+                # Our entry has been evicted and replaced while we were using it
+                self.size -= other.size
+                other.size = 0
+            self.size += size - entry.size
+            entry.size = size
+            entry.timestamp = timestamp or time.time()
+            entry.started = started or entry.timestamp
+            self.cache[key] = entry
+            heapq.heappush(
+                self.expiries, (entry.timestamp + self.max_age, next(self.seq), key, entry)
+            )
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def is_full(self):
+        return (
+            self.max_entries is not None and len(self.cache) > self.max_entries or
+            self.max_size is not None and self.size > self.max_size
+        )
+
+    def evict(self):
+        """Remove the least recently used entries until the shard isn't full.
+
+        Must be called with the shard's lock acquired. The entries that are
+        currently in use are skipped.
+        """
+        if not self.is_full():
+            return
+        for key, entry in list(self.cache.items()):
+            if not entry.lock.acquire(False):
+                continue
+            try:  # critical section
+                self.remove(key, entry)
+                self.evictions += 1
+            finally:
+                entry.lock.release()
+            if not self.is_full():
+                break
+
+    def prune(self, now):
+        """Remove the entries that haven't been refreshed for `max_age` seconds.
+
+        Must be called with the shard's lock acquired. The entries that are
+        currently in use are checked again later.
+        """
+        expiries = self.expiries
+        while expiries and expiries[0][0] <= now:
+            expiry, i, key, entry = heapq.heappop(expiries)
+            if self.cache.get(key) is not entry or entry.timestamp + self.max_age > now:
+                # The entry has been removed or refreshed since
+                continue
+            if not entry.lock.acquire(False):
+                heapq.heappush(expiries, (now + self.max_age, next(self.seq), key, entry))
+                continue
+            try:  # critical section
+                self.remove(key, entry)
+            finally:
+                entry.lock.release()
+
+    def remove(self, key, entry):
+        del self.cache[key]
+        self.size -= entry.size
+        entry.size = 0
+
+
+class FrozenRecord(object):
+    """The serializable form of a database record.
+    """
+
+    __slots__ = ('fields', 'values')
+
+    def __init__(self, fields, values):
+        self.fields = fields
+        self.values = values
+
+    def __getstate__(self):
+        return (self.fields, self.values)
+
+    def __setstate__(self, state):
+        self.fields, self.values = state
+
+
+record_classes = {}
+
+
+def freeze(obj):
+    """Convert the database records contained in `obj` into `FrozenRecord`s.
+    """
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return FrozenRecord(tuple(obj._fields), tuple(freeze(v) for v in obj))
+    elif type(obj) in (list, tuple):
+        return type(obj)(freeze(v) for v in obj)
+    elif type(obj) is dict:
+        return dict((k, freeze(v)) for k, v in obj.items())
+    return obj
+
+
+def thaw(obj):
+    """Convert the `FrozenRecord`s contained in `obj` back into records.
+    """
+    if isinstance(obj, FrozenRecord):
+        cls = record_classes.get(obj.fields)
+        if cls is None:
+            cls = record_classes[obj.fields] = namedtuple('Record', obj.fields)
+        return cls(*(thaw(v) for v in obj.values))
+    elif type(obj) in (list, tuple):
+        return type(obj)(thaw(v) for v in obj)
+    elif type(obj) is dict:
+        return dict((k, thaw(v)) for k, v in obj.items())
+    return obj
+
+
+class SharedStore(object):
+    """Store query results in files, so that all the processes of a host (e.g.
+    the gunicorn workers) can use them.
+
+    The directory should be on a memory-backed filesystem, like `/dev/shm`.
+    Each result is pickled into its own file, along with the time at which
+    the query was run. An exclusive lock on a companion file ensures that only
+    one process runs a given query at a time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def path(self, key):
+        return os.path.join(
+            self.directory, hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        )
+
+    def get(self, key, max_age, invalidated_at=0):
+        """Return a `(started, timestamp, result)` tuple, or `None` if there
+        isn't a result younger than `max_age` seconds from a query started
+        after `invalidated_at`.
+        """
+        try:
+            with open(self.path(key), 'rb') as f:
+                stored_key, started, timestamp, result = pickle.load(f)
+        except Exception:
+            return
+        if stored_key != key or time.time() - timestamp >= max_age:
+            return
+        if started < invalidated_at:
+            return
+        return started, timestamp, thaw(result)
+
+    def set(self, key, started, timestamp, result):
+        """Store a result. Results that can't be pickled are silently skipped.
+        """
+        try:
+            data = pickle.dumps(
+                (key, started, timestamp, freeze(result)), pickle.HIGHEST_PROTOCOL
+            )
+        except Exception:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def lock(self, key):
+        """Return an open file that is exclusively locked for this key.
+
+        Closing the file releases the lock.
+        """
+        f = open(self.path(key) + '.lock', 'ab')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def prune(self, max_age):
+        """Delete the files that haven't been modified for `max_age` seconds.
+        """
+        limit = time.time() - max_age
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < limit:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
 class QueryCache(object):
     """Implement a caching SQL post-processor.
 
@@ -52,9 +384,31 @@ class QueryCache(object):
     setting (1 or 2 seconds): the page will appear dynamic to any given user,
     but 100 requests in the same second will only result in one database call.
 
-    This object also features a pruning thread, which removes stale cache
-    entries on a more relaxed schedule (default: 60 seconds). It keeps the
-    cache clean without interfering too much with actual usage.
+    Stale cache entries are removed on a more relaxed schedule (default: 60
+    seconds), both when the cache is accessed and by a pruning thread shared
+    by all the instances. It keeps the cache clean without interfering too
+    much with actual usage.
+
+    The cache is split into <shards> parts, by hash of the key, each with its
+    own lock, so that threads looking up different queries rarely wait for
+    each other. Each shard holds at most 1/<shards> of <max_entries> entries
+    and of <max_size> bytes (estimated), the least recently used entries are
+    evicted when a limit is exceeded. The `stats` method returns the hit, miss,
+    eviction and lock wait counters.
+
+    If <shared_dir> is set, the results are also stored in that directory, so
+    that they're shared with the other processes of the host, see
+    `SharedStore`.
+
+    Queries can be tagged with the names of the tables they depend on. Tagged
+    results are dropped as soon as the database notifies a change in one of
+    those tables, see `Listener`, so while the listener is connected they can
+    be cached for <tagged_threshold> seconds instead of <threshold>.
+
+    With a non-zero <stale_ttl>, an expired result is still served during
+    <stale_ttl> more seconds, while a single background thread refreshes it,
+    so that callers don't have to wait for the query. Exceptions are never
+    served stale.
 
     If the actual database call or the formatting callback raise an Exception,
     then that is cached as well, and will be raised on further calls until the
@@ -66,39 +420,43 @@ class QueryCache(object):
     """
 
     db = None               # PostgresManager object
-    cache = None            # the query cache [dictionary]
-    locks = None            # access controls for self.cache [Locks]
+    shards = None           # the parts of the query cache [list of Shard]
     threshold = 5           # maximum life of a cache entry [seconds as int]
     threshold_prune = 60    # time between pruning runs [seconds as int]
+    stale_ttl = 0           # how long an expired result can be served [seconds]
 
 
-    def __init__(self, db, threshold=5, threshold_prune=60):
+    def __init__(self, db, threshold=5, threshold_prune=60, shards=16,
+                 max_entries=10000, max_size=64*1024*1024, stale_ttl=0,
+                 shared_dir=None, tagged_threshold=None):
         """
         """
         self.db = db
+        self.tagged_threshold = tagged_threshold
+        self.shared = SharedStore(shared_dir) if shared_dir else None
         self.threshold = threshold
+        self.stale_ttl = stale_ttl
         self.threshold_prune = threshold_prune
-        self.cache = {}
-
-        class Locks:
-            checkin = threading.Lock()
-            checkout = threading.Lock()
-        self.locks = Locks()
+        # Tagged results can stay valid for longer than `threshold_prune`
+        max_age = max(threshold_prune, tagged_threshold or 0)
+        per_shard = lambda limit: None if limit is None else max(limit // shards, 1)
+        self.shards = [
+            Shard(per_shard(max_entries), per_shard(max_size), max_age)
+            for i in range(shards)
+        ]
 
-        self.pruner = threading.Thread(target=self.prune)
-        self.pruner.setDaemon(True)
-        self.pruner.start()
+        pruner.register(self)
 
 
-    def one(self, query, params=None, process=None):
-        return self._do_query(self.db.one, query, params, process)
+    def one(self, query, params=None, process=None, tags=()):
+        return self._do_query(self.db.one, query, params, process, tags)
 
-    def all(self, query, params=None, process=None):
+    def all(self, query, params=None, process=None, tags=()):
         if process is None:
             process = lambda g: list(g)
-        return self._do_query(self.db.all, query, params, process)
+        return self._do_query(self.db.all, query, params, process, tags)
 
-    def _do_query(self, fetchfunc, query, params, process):
+    def _do_query(self, fetchfunc, query, params, process, tags=()):
         """Given a function, a SQL string, a tuple, and a function, return ???.
         """
 
@@ -106,51 +464,37 @@ class QueryCache(object):
         # ====================
 
         key = (query, params)
+        shard = self.shards[hash(key) % len(self.shards)]
+        if tags and self.tagged_threshold and listener.listening:
+            threshold = self.tagged_threshold
+        else:
+            threshold = self.threshold
+        invalidated_at = listener.invalidated_at(tags)
+
+
+        # Serve a cached result.
+        # ======================
+        # Valid results are returned without waiting for the entry's lock.
+
+        r = shard.serve(key, threshold, self.stale_ttl, invalidated_at)
+        if r is not None:
+            result, refresh = r
+            if refresh:
+                refresher = threading.Thread(
+                    target=self._refresh,
+                    args=(shard, key, fetchfunc, query, params, process, threshold),
+                )
+                refresher.daemon = True
+                refresher.start()
+            return result
 
 
         # Check out an entry.
         # ===================
         # Each entry has its own lock, and "checking out" an entry means
-        # acquiring that lock. If a queryset isn't yet in our cache, we first
-        # "check in" a new dummy entry for it (and prevent other threads from
-        # adding the same query), which will be populated presently.
+        # acquiring that lock.
 
-        self.locks.checkout.acquire()
-        try:  # critical section
-            if key in self.cache:
-
-                # Retrieve an already cached query.
-                # =================================
-                # The cached entry may be a dummy. The best way to guarantee we
-                # will catch this case is to simply refresh our entry after we
-                # acquire its lock.
-
-                entry = self.cache[key]
-                entry.lock.acquire()
-                entry = self.cache[key]
-
-            else:
-
-                # Add a new entry to our cache.
-                # =============================
-
-                dummy = Entry()
-                dummy.lock.acquire()
-                self.locks.checkin.acquire()
-                try:  # critical section
-                    if key in self.cache:
-                        # Someone beat us to it. XXX: can this actually happen?
-                        entry = self.cache[key]
-                    else:
-                        self.cache[key] = dummy
-                        entry = dummy
-                finally:
-                    self.locks.checkin.release()
-
-        finally:
-            # Now that we've checked out our queryset, other threads are free
-            # to check out other queries.
-            self.locks.checkout.release()
+        entry = shard.checkout(key)
 
 
         # Process the query.
@@ -161,80 +505,192 @@ class QueryCache(object):
             # Decide whether it's a hit or miss.
             # ==================================
 
-            if time.time() - entry.timestamp < self.threshold:  # cache hit
-                if entry.exc is not None:
-                    raise entry.exc
+            age = time.time() - entry.timestamp
+            if age < threshold and entry.started >= invalidated_at:  # cache hit
+                shard.count('hits')
+            else:                                                  # cache miss
+                self._run(shard, key, entry, fetchfunc, query, params, process,
+                          threshold, invalidated_at)
+
+            if entry.exc is not None:
+                raise entry.exc[0]
+            else:
                 return entry.result
 
-            else:                                               # cache miss
-                try:                    # XXX uses postgres.py api, not dbapi2!
-                    entry.result = fetchfunc(query, params)
-                    if process is not None:
-                        entry.result = process(entry.result)
-                    entry.exc = None
-                except:
-                    entry.result = None
-                    entry.exc = (
-                        FormattingError(traceback.format_exc()),
-                        sys.exc_info()[2]
-                    )
+        finally:
+            entry.lock.release()
 
 
-            # Check the queryset back in.
-            # ===========================
+    def _run(self, shard, key, entry, fetchfunc, query, params, process,
+             threshold, invalidated_at, counter='misses'):
+        """Run a query and check its result into the cache.
 
-            self.locks.checkin.acquire()
-            try:  # critical section
-                entry.timestamp = time.time()
-                self.cache[key] = entry
-                if entry.exc is not None:
-                    raise entry.exc[0]
-                else:
-                    return entry.result
-            finally:
-                self.locks.checkin.release()
+        If there is a shared store, the result is looked up in it first, and
+        the query is only run by one process at a time.
+        """
+        lock, started, timestamp = None, None, None
+        try:                    # XXX uses postgres.py api, not dbapi2!
+            if self.shared:
+                shared = self.shared.get(key, threshold, invalidated_at)
+                if shared is None:
+                    lock = self.shared.lock(key)
+                    # Another process may have run the query while we waited
+                    shared = self.shared.get(key, threshold, invalidated_at)
+            else:
+                shared = None
+            if shared is None:
+                started = time.time()
+                result = fetchfunc(query, params)
+                if process is not None:
+                    result = process(result)
+                timestamp = time.time()
+                if self.shared:
+                    self.shared.set(key, started, timestamp, result)
+            else:
+                started, timestamp, result = shared
+                if counter == 'misses':
+                    counter = 'shared_hits'
+            exc = None
+        except:
+            result = None
+            exc = (
+                FormattingError(traceback.format_exc()),
+                sys.exc_info()[2]
+            )
+        finally:
+            if lock:
+                lock.close()
+        shard.checkin(key, entry, result, exc, counter, timestamp, started)
 
+
+    def _refresh(self, shard, key, fetchfunc, query, params, process, threshold):
+        """Refresh a stale entry, in a background thread.
+        """
+        entry = shard.checkout(key)
+        try:  # critical section
+            if time.time() - entry.timestamp >= threshold:
+                self._run(shard, key, entry, fetchfunc, query, params, process,
+                          threshold, 0, counter='refreshes')
         finally:
+            entry.refreshing = False
             entry.lock.release()
 
 
+    def stats(self):
+        """Return the counters of the cache, summed over all its shards.
+        """
+        counters = (
+            'size', 'hits', 'stale_hits', 'shared_hits', 'misses', 'refreshes',
+            'evictions', 'lock_waits',
+        )
+        r = dict.fromkeys(counters, 0)
+        r['entries'] = 0
+        for shard in self.shards:
+            r['entries'] += len(shard.cache)
+            for k in counters:
+                r[k] += getattr(shard, k)
+        return r
+
+
     def prune(self):
-        """Periodically remove any stale queries in our cache.
+        """Remove the stale queries from our cache.
         """
+        now = time.time()
+        for shard in self.shards:
+            shard.acquire()
+            try:  # critical section
+                shard.prune(now)
+            finally:
+                shard.lock.release()
+        if self.shared:
+            self.shared.prune(max(self.threshold_prune, self.tagged_threshold or 0))
 
-        last = 0  # timestamp of last pruning run
 
-        while 1:
+class Pruner(object):
+    """A thread that periodically prunes all the query caches of the process.
+    """
 
-            if time.time() < last + self.threshold_prune:
-                # Not time to prune yet.
-                time.sleep(0.2)
-                continue
+    def __init__(self):
+        self.caches = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.thread = None
 
-            self.locks.checkout.acquire()
-            try:  # critical section
+    def register(self, cache):
+        with self.lock:
+            self.caches.add(cache)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
 
-                for key, entry in tuple(self.cache.items()):
+    def run(self):
+        while True:
+            time.sleep(max(min([c.threshold_prune for c in list(self.caches)] or [60]), 1))
+            for cache in list(self.caches):
+                cache.prune()
 
-                    # Check out the entry.
-                    # ====================
-                    # If the entry is currently in use, skip it.
 
-                    available = entry.lock.acquire(False)
-                    if not available:
-                        continue
+pruner = Pruner()
 
 
-                    # Remove the entry if it is too old.
-                    # ==================================
+class Listener(object):
+    """A thread that listens for the notifications sent by the database when
+    a table is modified, and records when each table was last modified.
 
-                    try:  # critical section
-                        if time.time() - entry.timestamp > self.threshold_prune:
-                            del self.cache[key]
-                    finally:
-                        entry.lock.release()
+    The notifications are sent by the `notify_query_cache` triggers, on the
+    `query_cache` channel, with the name of the table as payload.
+    """
 
+    channel = 'query_cache'
+
+    def __init__(self):
+        self.invalidated = {}
+        self.reset_at = 0
+        self.listening = False
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, dsn):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=(dsn,))
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self, dsn):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.autocommit = True
+                conn.cursor().execute("LISTEN " + self.channel)
+                # We may have missed notifications while we weren't connected
+                self.reset_at = time.time()
+                self.listening = True
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    self.invalidate(*[n.payload for n in conn.notifies])
+                    del conn.notifies[:]
+            except Exception:
+                self.listening = False
+                time.sleep(5)
             finally:
-                self.locks.checkout.release()
+                if conn is not None:
+                    conn.close()
+
+    def invalidate(self, *tags):
+        now = time.time()
+        for tag in tags:
+            self.invalidated[tag] = now
+
+    def invalidated_at(self, tags):
+        """Return the last time a table among `tags` was modified, or 0.
+        """
+        if not tags:
+            return 0
+        return max([self.reset_at] + [self.invalidated.get(tag, 0) for tag in tags])
+
 
-            last = time.time()
+listener = Listener()
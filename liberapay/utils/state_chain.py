@@ -14,6 +14,7 @@ from requests.exceptions import ConnectionError, Timeout
 
 from .. import constants
 from ..exceptions import LazyResponse
+from ..models.participant import Participant
 
 
 def create_response_object(request, website):
@@ -82,6 +83,29 @@ def insert_constants():
     return {'constants': constants}
 
 
+def start_identity_map(request, user):
+    """Keep the participants loaded during a safe request in an identity map.
+
+    Unsafe requests can modify participants, so they always get fresh data.
+    """
+    Participant.stop_identity_map()
+    if request.method in ('GET', 'HEAD'):
+        identity_map = Participant.start_identity_map()
+        if not user.ANON:
+            identity_map.add(user)
+        return {'identity_map': identity_map}
+
+
+def stop_identity_map(website, response, identity_map=None):
+    """Drop the identity map, and expose its hit count in debug mode.
+    """
+    Participant.stop_identity_map()
+    if identity_map and website.env.logging_level == 'debug':
+        response.headers[b'X-Identity-Map'] = (
+            'hits=%i, misses=%i' % (identity_map.hits, identity_map.misses)
+        ).encode('ascii')
+
+
 def _dispatch_path_to_filesystem(website, request=None):
     """This wrapper function neutralizes some of Aspen's dispatch exceptions.
 
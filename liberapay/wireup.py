@@ -40,7 +40,7 @@ from liberapay.utils.i18n import (
     ALIASES, ALIASES_R, COUNTRIES, LANGUAGES_2, LOCALES,
     get_function_from_rule, make_sorted_dict
 )
-from liberapay.utils.query_cache import QueryCache
+from liberapay.utils.query_cache import QueryCache, listener as query_cache_listener
 
 
 def canonical(env):
@@ -91,10 +91,18 @@ def database(env, tell_sentry):
     for model in models:
         db.register_model(model)
     liberapay.billing.payday.Payday.db = db
+    liberapay.billing.payday.Payday.engine = env.payday_engine
+    liberapay.billing.payday.Payday.transfer_concurrency = env.payday_transfer_concurrency
+    liberapay.billing.payday.Payday.settlement_processes = env.payday_settlement_processes
 
     use_qc = not env.override_query_cache
-    qc1 = QueryCache(db, threshold=(1 if use_qc else 0))
-    qc5 = QueryCache(db, threshold=(5 if use_qc else 0))
+    shared_dir = (getattr(env, 'query_cache_dir', None) or None) if use_qc else None
+    qc1 = QueryCache(db, threshold=(1 if use_qc else 0), stale_ttl=(4 if use_qc else 0),
+                     shared_dir=shared_dir, tagged_threshold=(60 if use_qc else 0))
+    qc5 = QueryCache(db, threshold=(5 if use_qc else 0), stale_ttl=(25 if use_qc else 0),
+                     shared_dir=shared_dir, tagged_threshold=(300 if use_qc else 0))
+    if use_qc:
+        query_cache_listener.start(dburl)
 
     return {'db': db, 'db_qc1': qc1, 'db_qc5': qc5}
 
@@ -132,6 +140,7 @@ class AppConf(object):
         mangopay_base_url=str,
         mangopay_client_id=str,
         mangopay_client_password=str,
+        merge_cash_bundles_every=int,
         openstreetmap_api_url=str,
         openstreetmap_auth_url=str,
         openstreetmap_callback=str,
@@ -498,7 +507,11 @@ def env():
         CLEAN_ASSETS=is_yesish,
         RUN_CRON_JOBS=is_yesish,
         OVERRIDE_PAYDAY_CHECKS=is_yesish,
+        PAYDAY_ENGINE=str,
+        PAYDAY_TRANSFER_CONCURRENCY=int,
+        PAYDAY_SETTLEMENT_PROCESSES=int,
         OVERRIDE_QUERY_CACHE=is_yesish,
+        QUERY_CACHE_DIR=str,
     )
 
     logging.basicConfig(level=getattr(logging, env.logging_level.upper()))
@@ -509,6 +522,20 @@ def env():
         if env.log_dir is None:
             env.missing.append(var_name+' (referenced by LOG_DIR)')
 
+    if getattr(env, 'payday_engine', 'sql') not in ('sql', 'python'):
+        env.malformed.append(('PAYDAY_ENGINE', "must be either 'sql' or 'python'"))
+
+    concurrency = getattr(env, 'payday_transfer_concurrency', None)
+    maxconn = getattr(env, 'database_maxconn', None)
+    if concurrency is not None and maxconn is not None and not 0 < concurrency < maxconn:
+        env.malformed.append((
+            'PAYDAY_TRANSFER_CONCURRENCY',
+            'must be a positive integer lower than DATABASE_MAXCONN',
+        ))
+
+    if getattr(env, 'payday_settlement_processes', 1) < 1:
+        env.malformed.append(('PAYDAY_SETTLEMENT_PROCESSES', 'must be a positive integer'))
+
     if env.malformed:
         plural = len(env.malformed) != 1 and 's' or ''
         print("=" * 42)
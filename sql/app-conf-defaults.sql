@@ -29,6 +29,7 @@ INSERT INTO app_conf (key, value) VALUES
     ('mangopay_base_url', '"https://api.sandbox.mangopay.com"'::jsonb),
     ('mangopay_client_id', '"liberapay-dev"'::jsonb),
     ('mangopay_client_password', '"Toi8KBqA3UDSWKgEcC7CLqup3kcaDUSTmy4hN3UiKz6ZUJCZz1"'::jsonb),
+    ('merge_cash_bundles_every', '60'::jsonb),
     ('openstreetmap_api_url', '"http://www.openstreetmap.org/api/0.6"'::jsonb),
     ('openstreetmap_auth_url', '"http://www.openstreetmap.org"'::jsonb),
     ('openstreetmap_callback', '"http://127.0.0.1:8339/on/openstreetmap/associate"'::jsonb),
@@ -44,4 +45,5 @@ INSERT INTO app_conf (key, value) VALUES
     ('twitter_callback', '"http://127.0.0.1:8339/on/twitter/associate"'::jsonb),
     ('twitter_id', '"h8bBZtoPNz63S5RkZdbo9R5zb"'::jsonb),
     ('twitter_secret', '"Jye64vkWxa2dQu64feTnk0BM3j4JO8ZlTa4EQvMDwrweLkwPaw"'::jsonb),
-    ('update_global_stats_every', '300'::jsonb);
+    ('update_global_stats_every', '300'::jsonb)
+ON CONFLICT (key) DO NOTHING;
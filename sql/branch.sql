@@ -0,0 +1,162 @@
+CREATE TABLE take_totals
+( tipper   bigint          NOT NULL REFERENCES participants
+, team     bigint          NOT NULL REFERENCES participants
+, amount   numeric(35,2)   NOT NULL
+, UNIQUE (tipper, team)
+);
+
+CREATE OR REPLACE FUNCTION update_take_totals() RETURNS trigger AS $$
+    DECLARE
+        old_amount numeric(35,2) = (CASE
+            WHEN TG_OP = 'INSERT' THEN 0
+            WHEN OLD.context = 'take' AND OLD.status = 'succeeded' THEN OLD.amount
+            ELSE 0
+        END);
+        new_amount numeric(35,2) = (CASE
+            WHEN NEW.context = 'take' AND NEW.status = 'succeeded' THEN NEW.amount
+            ELSE 0
+        END);
+    BEGIN
+        IF (new_amount = old_amount) THEN
+            RETURN NULL;
+        END IF;
+        INSERT INTO take_totals
+                    (tipper, team, amount)
+             VALUES (NEW.tipper, NEW.team, new_amount - old_amount)
+        ON CONFLICT (tipper, team) DO UPDATE
+                SET amount = take_totals.amount + EXCLUDED.amount;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+BEGIN;
+    LOCK TABLE transfers IN EXCLUSIVE MODE;
+    INSERT INTO take_totals
+                (tipper, team, amount)
+         SELECT tipper, team, sum(amount)
+           FROM transfers
+          WHERE context = 'take'
+            AND status = 'succeeded'
+       GROUP BY tipper, team;
+    CREATE TRIGGER update_take_totals
+        AFTER INSERT OR UPDATE OF status ON transfers
+        FOR EACH ROW
+        EXECUTE PROCEDURE update_take_totals();
+END;
+
+CREATE INDEX exchanges_refund_ref_idx ON exchanges (refund_ref) WHERE refund_ref IS NOT NULL;
+
+CREATE FUNCTION exchange_stats(e exchanges, refunded boolean)
+RETURNS numeric(35,2)[] AS $$
+    SELECT (CASE WHEN e.status = 'failed' THEN ARRAY[0, 0, 0, 0] ELSE ARRAY[
+        (CASE WHEN e.amount > 0 AND e.refund_ref IS NULL AND e.status = 'succeeded' THEN e.amount ELSE 0 END),
+        (CASE WHEN e.amount > 0 AND refunded THEN e.amount ELSE 0 END),
+        (CASE WHEN e.amount < 0 AND e.refund_ref IS NULL THEN -e.amount ELSE 0 END),
+        (CASE WHEN e.amount < 0 AND refunded THEN e.amount ELSE 0 END)
+    ] END)::numeric(35,2)[];
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION add_exchange_stats(ts timestamptz, delta numeric(35,2)[])
+RETURNS void AS $$
+    UPDATE paydays
+       SET week_deposits = week_deposits + delta[1]
+         , week_deposits_refunded = COALESCE(week_deposits_refunded, 0) + delta[2]
+         , week_withdrawals = week_withdrawals + delta[3]
+         , week_withdrawals_refunded = COALESCE(week_withdrawals_refunded, 0) + delta[4]
+     WHERE id = ( SELECT id FROM paydays WHERE ts_start > ts ORDER BY ts_start LIMIT 1 )
+       AND ts_end > ts_start
+       AND delta <> ARRAY[0, 0, 0, 0]::numeric(35,2)[];
+$$ LANGUAGE sql;
+
+CREATE FUNCTION update_payday_exchange_stats() RETURNS trigger AS $$
+    DECLARE
+        refunded boolean = EXISTS (SELECT 1 FROM exchanges e WHERE e.refund_ref = NEW.id);
+        old_stats numeric(35,2)[] = (CASE
+            WHEN TG_OP = 'INSERT' THEN ARRAY[0, 0, 0, 0]::numeric(35,2)[]
+            ELSE exchange_stats(OLD, refunded)
+        END);
+        orig exchanges;
+    BEGIN
+        PERFORM add_exchange_stats(NEW.timestamp, (
+            SELECT array_agg(n - o)
+              FROM unnest(exchange_stats(NEW, refunded), old_stats) x (n, o)
+        ));
+        IF (TG_OP = 'INSERT' AND NEW.refund_ref IS NOT NULL) THEN
+            IF (NOT EXISTS (
+                SELECT 1 FROM exchanges e WHERE e.refund_ref = NEW.refund_ref AND e.id <> NEW.id
+            )) THEN
+                -- This is the first refund of the original exchange
+                orig := (SELECT e FROM exchanges e WHERE e.id = NEW.refund_ref);
+                PERFORM add_exchange_stats(orig.timestamp, (
+                    SELECT array_agg(n - o)
+                      FROM unnest(exchange_stats(orig, true), exchange_stats(orig, false)) x (n, o)
+                ));
+            END IF;
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_payday_exchange_stats
+    AFTER INSERT OR UPDATE OF status ON exchanges
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_payday_exchange_stats();
+
+CREATE FUNCTION update_payday_transfer_stats() RETURNS trigger AS $$
+    DECLARE
+        delta numeric(35,2) = (CASE
+            WHEN NEW.status <> 'succeeded' OR NEW.context = 'refund' THEN 0
+            WHEN OLD.refund_ref IS NULL AND NEW.refund_ref IS NOT NULL THEN NEW.amount
+            WHEN OLD.refund_ref IS NOT NULL AND NEW.refund_ref IS NULL THEN -NEW.amount
+            ELSE 0
+        END);
+    BEGIN
+        IF (delta = 0) THEN
+            RETURN NULL;
+        END IF;
+        UPDATE paydays
+           SET transfer_volume_refunded = COALESCE(transfer_volume_refunded, 0) + delta
+         WHERE ts_start <= NEW.timestamp
+           AND ts_end >= NEW.timestamp;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_payday_transfer_stats
+    AFTER UPDATE OF refund_ref ON transfers
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_payday_transfer_stats();
+
+CREATE INDEX invoice_events_invoice_idx ON invoice_events (invoice, ts DESC);
+CREATE INDEX invoices_accepted_idx ON invoices (addressee, id) WHERE status = 'accepted';
+
+CREATE TABLE cash_bundles_to_merge
+( owner   bigint   PRIMARY KEY REFERENCES participants
+);
+
+INSERT INTO app_conf (key, value) VALUES
+    ('merge_cash_bundles_every', '60'::jsonb);
+
+CREATE FUNCTION notify_query_cache() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('query_cache', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_query_cache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON participants
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_query_cache();
+CREATE TRIGGER notify_query_cache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON tips
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_query_cache();
+CREATE TRIGGER notify_query_cache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON takes
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_query_cache();
+CREATE TRIGGER notify_query_cache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON paydays
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_query_cache();
+CREATE TRIGGER notify_query_cache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON communities
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_query_cache();
+CREATE TRIGGER notify_query_cache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON community_memberships
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_query_cache();
+CREATE TRIGGER notify_query_cache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON statements
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_query_cache();
+CREATE TRIGGER notify_query_cache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON elsewhere
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_query_cache();
@@ -1,7 +1,9 @@
 from __future__ import print_function, unicode_literals
 
-from liberapay.utils import fake_data
+from liberapay.billing.payday import Payday
 from liberapay.testing import Harness
+from liberapay.testing.mangopay import FakeTransfersHarness
+from liberapay.utils import fake_data
 
 
 class TestFakeData(Harness):
@@ -25,3 +27,16 @@ class TestFakeData(Harness):
         assert len(tips) == num_tips
         assert len(participants) == num_participants + num_teams + num_communities
         assert len(transfers) == num_transfers
+
+
+class TestFakeDataInBulk(FakeTransfersHarness):
+
+    def test_populate_db_in_bulk(self):
+        counts = fake_data.populate_db_in_bulk(self.db, num_participants=50, num_teams=3, seed=0)
+        assert counts['participants'] == 53
+        assert self.db.one("SELECT count(*) FROM tips") == counts['tips']
+        assert self.db.one("SELECT count(*) FROM takes") == counts['takes']
+        assert self.db.one("SELECT count(*) FROM exchanges") == counts['exchanges']
+        self.db.self_check()
+        Payday.start().run()
+        assert self.db.one("SELECT count(*) FROM transfers") > 0
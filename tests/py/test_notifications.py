@@ -1,4 +1,6 @@
+from liberapay.models.participant import Participant
 from liberapay.testing import Harness
+from liberapay.utils import deserialize
 from liberapay.utils.emails import jinja_env_html, SimplateLoader
 
 
@@ -10,6 +12,34 @@ class TestNotifications(Harness):
         alice.add_notification('1234')
         assert alice.pending_notifs == 2
 
+    def test_notify_many(self):
+        alice = self.make_participant('alice')
+        bob = self.make_participant('bob')
+        self.db.run("UPDATE participants SET email_notif_bits = 0 WHERE id = %s", (bob.id,))
+        Participant.notify_many([
+            (alice.id, 'income', dict(total=1)),
+            (bob.id, 'income', dict(total=2)),
+            (alice.id, 'low_balance', dict(low_balance=3)),
+        ])
+        assert alice.refetch().pending_notifs == 2
+        assert bob.refetch().pending_notifs == 1
+        notifs = self.db.all("SELECT participant, event, context FROM notification_queue ORDER BY id")
+        assert [(n.participant, n.event, deserialize(n.context)) for n in notifs] == [
+            (alice.id, 'income', dict(total=1)),
+            (bob.id, 'income', dict(total=2)),
+            (alice.id, 'low_balance', dict(low_balance=3)),
+        ]
+        emails = self.db.all("SELECT participant, spt_name FROM email_queue ORDER BY id")
+        assert emails == [(alice.id, 'income'), (alice.id, 'low_balance')]
+
+    def test_notify_many_can_force_emails(self):
+        alice = self.make_participant('alice')
+        self.db.run("UPDATE participants SET email_notif_bits = 0 WHERE id = %s", (alice.id,))
+        Participant.notify_many([(alice.id, 'identity_required', {})], force_email=True)
+        emails = self.db.all("SELECT participant, spt_name FROM email_queue")
+        assert emails == [(alice.id, 'identity_required')]
+        assert alice.refetch().pending_notifs == 1
+
     def test_remove_notification(self):
         alice = self.make_participant('alice')
         bob = self.make_participant('bob')
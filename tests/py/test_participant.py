@@ -110,6 +110,29 @@ class TestParticipant(Harness):
         assert self.alice != None
         assert not (self.alice == None)
 
+    def test_from_ids(self):
+        r = Participant.from_ids([self.alice.id, self.carl.id, self.carl.id, -1])
+        assert r == {self.alice.id: self.alice, self.carl.id: self.carl}
+        assert Participant.from_ids([]) == {}
+
+    def test_identity_map(self):
+        identity_map = Participant.start_identity_map()
+        try:
+            alice = Participant.from_id(self.alice.id)
+            assert alice is not self.alice
+            assert Participant.from_id(self.alice.id) is alice
+            assert Participant.from_username('ALICE') is alice
+            r = Participant.from_ids([self.alice.id, self.bob.id])
+            assert r[self.alice.id] is alice
+            assert Participant.from_username('bob') is r[self.bob.id]
+            assert (identity_map.hits, identity_map.misses) == (4, 2)
+            fresh_alice = alice.refetch()
+            assert fresh_alice is not alice
+            assert Participant.from_id(self.alice.id) is fresh_alice
+        finally:
+            assert Participant.stop_identity_map() is identity_map
+        assert Participant.from_id(self.alice.id) is not fresh_alice
+
     def test_cant_take_over_claimed_participant_without_confirmation(self):
         with self.assertRaises(NeedConfirmation):
             self.alice.take_over(('twitter', '', str(self.bob.id)))
@@ -347,6 +370,32 @@ class Tests(Harness):
         funded_tips = self.db.all("SELECT amount FROM tips WHERE is_funded ORDER BY id")
         assert funded_tips == [3, 6, 5]
 
+    def test_update_giving_skips_the_tips_that_cant_be_funded(self):
+        alice = self.make_participant('alice', balance=10)
+        bob = self.make_participant('bob')
+        carl = self.make_participant('carl')
+        dana = self.make_participant('dana')
+        alice.set_tip_to(bob, '6.00')
+        alice.set_tip_to(carl, '5.00')
+        alice.set_tip_to(dana, '3.00')
+        funded = lambda: dict(self.db.all("""
+            SELECT p.username, t.is_funded
+              FROM tips t
+              JOIN participants p ON p.id = t.tippee
+        """))
+        assert funded() == {'bob': True, 'carl': False, 'dana': True}
+        assert alice.giving == Decimal('9.00')
+
+        self.db.run("UPDATE participants SET balance = 5 WHERE id = %s", (alice.id,))
+        alice = alice.refetch()
+        updated = alice.update_giving()
+        assert [(t.tippee, t.is_funded) for t in updated] == [
+            (bob.id, False), (carl.id, True), (dana.id, False),
+        ]
+        assert funded() == {'bob': False, 'carl': True, 'dana': False}
+        assert alice.giving == Decimal('5.00')
+        assert alice.update_giving() == []
+
     def test_only_latest_tip_counts(self):
         alice = self.make_participant('alice', balance=100)
         bob = self.make_participant('bob', balance=100)
@@ -3,16 +3,30 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from decimal import Decimal as D
 import json
 import os
+import pickle
+import re
+import threading
+import time
 
 import mock
 
-from liberapay.billing.payday import main, NoPayday, Payday
-from liberapay.exceptions import NegativeBalance
+from liberapay.billing.exchanges import (
+    _record_transfer_result, merge_scheduled_cash_bundles, record_transfer_results,
+    send_transfer,
+)
+from liberapay.billing.journal import Journal, PENDING, STARTED
+from liberapay.billing.payday import execute_transfers, main, NoPayday, NS, Payday, simulate
+from liberapay.billing.settlement import split_components, TipGraph
+from liberapay.exceptions import NegativeBalance, TransferError
 from liberapay.models.participant import Participant
-from liberapay.testing.mangopay import FakeTransfersHarness, MangopayHarness
+from liberapay.testing.mangopay import FakeTransfersHarness, MangopayHarness, fake_transfer
 from liberapay.testing.emails import EmailHarness
 
 
+class Crash(Exception):
+    pass
+
+
 class TestPayday(EmailHarness, FakeTransfersHarness, MangopayHarness):
 
     @mock.patch('liberapay.billing.payday.date')
@@ -59,6 +73,123 @@ class TestPayday(EmailHarness, FakeTransfersHarness, MangopayHarness):
 
         assert self.transfer_mock.call_count
 
+    @mock.patch.object(Payday, 'transfer_concurrency', 3)
+    def test_payday_moves_money_concurrently(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        alice = self.make_participant('alice', balance=5)
+        self.janet.set_tip_to(self.homer, '6.00')
+        self.homer.set_tip_to(self.david, '5.00')  # funded by janet's tip
+        self.david.set_tip_to(alice, '4.00')  # funded by homer's tip
+        alice.set_tip_to(self.janet, '1.00')
+        Payday.start().run()
+
+        d = dict(self.db.all("SELECT username, balance FROM participants"))
+        assert d == {
+            'alice': D('8.00'),
+            'david': D('1.00'),
+            'homer': D('1.00'),
+            'janet': D('5.00'),
+        }
+        assert self.transfer_mock.call_count == 4
+
+    @mock.patch.object(Payday, 'transfer_batch_size', 2)
+    @mock.patch.object(Payday, 'transfer_concurrency', 3)
+    def test_payday_records_transfers_in_batches(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        alice = self.make_participant('alice', balance=5)
+        self.janet.set_tip_to(self.homer, '6.00')
+        self.janet.set_tip_to(self.david, '1.00')
+        self.homer.set_tip_to(self.david, '5.00')  # funded by janet's tip
+        self.david.set_tip_to(alice, '4.00')  # funded by homer's tip
+        alice.set_tip_to(self.janet, '1.00')
+        with mock.patch('liberapay.billing.payday.record_transfer_results',
+                        side_effect=record_transfer_results) as rtr:
+            Payday.start().run()
+        assert [len(c[0][1]) for c in rtr.call_args_list] == [2, 2, 1]
+        statuses = self.db.all("SELECT status FROM transfers")
+        assert statuses == ['succeeded'] * 5
+        d = dict(self.db.all("SELECT username, balance FROM participants"))
+        assert d == {
+            'alice': D('8.00'),
+            'david': D('2.00'),
+            'homer': D('1.00'),
+            'janet': D('4.00'),
+        }
+
+    def test_payday_merges_cash_bundles_once_at_the_end(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        self.janet.set_tip_to(self.homer, '6.00')
+        self.homer.set_tip_to(self.janet, '1.00')  # funded by janet's tip
+        self.homer.set_tip_to(self.david, '2.00')  # funded by janet's tip
+        with mock.patch('liberapay.billing.payday.merge_scheduled_cash_bundles',
+                        side_effect=merge_scheduled_cash_bundles) as merge:
+            Payday.start().run()
+        assert merge.call_count == 1
+        assert self.db.one("SELECT count(*) FROM cash_bundles_to_merge") == 0
+        bundles = self.db.all("""
+            SELECT p.username, b.amount
+              FROM cash_bundles b
+              JOIN participants p ON p.id = b.owner
+          ORDER BY p.username
+        """)
+        assert [tuple(b) for b in bundles] == [
+            ('david', D('2.00')), ('homer', D('3.00')), ('janet', D('5.00')),
+        ]
+
+    def test_payday_stops_when_a_transfer_fails(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        self.janet.set_tip_to(self.homer, '6.00')
+        self.janet.set_tip_to(self.david, '1.00')
+
+        def fail_transfer(tr):
+            fake_transfer(tr)
+            if tr.CreditedWalletId == self.homer.mangopay_wallet_id:
+                tr.Status = 'FAILED'
+                tr.ResultCode = '001001'
+                tr.ResultMessage = 'Unsufficient wallet balance'
+
+        self.transfer_mock.side_effect = fail_transfer
+        payday = Payday.start()
+        with self.assertRaises(TransferError):
+            payday.shuffle()
+        os.unlink(payday.transfers_filename)
+        transfers = dict(self.db.all("SELECT tippee, status FROM transfers"))
+        assert transfers[self.homer.id] == 'failed'
+        assert self.homer.refetch().balance == 0
+
+    def test_execute_transfers_never_runs_two_transfers_of_a_participant_at_once(self):
+        transfers = [NS(dict(tipper=i % 5, tippee=5 + i % 3)) for i in range(30)]
+        busy, executed = set(), []
+        lock = threading.Lock()
+
+        def f(i, t):
+            with lock:
+                assert not busy & {t.tipper, t.tippee}
+                busy.update((t.tipper, t.tippee))
+            time.sleep(0.001)
+            with lock:
+                busy.difference_update((t.tipper, t.tippee))
+                executed.append(i)
+
+        execute_transfers(transfers, f, concurrency=4)
+        assert sorted(executed) == list(range(30))
+        for p_id in range(8):
+            order = [i for i in executed if p_id in (transfers[i].tipper, transfers[i].tippee)]
+            assert order == sorted(order)
+
+    def test_execute_transfers_stops_after_an_error(self):
+        transfers = [NS(dict(tipper=1, tippee=2)) for i in range(5)]
+        executed = []
+
+        def f(i, t):
+            if i == 2:
+                raise ValueError(i)
+            executed.append(i)
+
+        with self.assertRaises(ValueError):
+            execute_transfers(transfers, f, concurrency=4)
+        assert executed == [0, 1]
+
     def test_update_cached_amounts(self):
         team = self.make_participant('team', kind='group')
         alice = self.make_participant('alice', balance=100)
@@ -218,6 +349,75 @@ class TestPayday(EmailHarness, FakeTransfersHarness, MangopayHarness):
         for args, _ in log.call_args_list:
             assert args[0] == expected_logging_call_args.pop()
 
+    def get_stored_stats(self, payday_id, stats):
+        return self.db.one("""
+            SELECT {0} FROM paydays WHERE id = %s
+        """.format(', '.join(stats)), (payday_id,), back_as=dict)
+
+    def test_stats_of_ended_paydays_are_updated_by_triggers(self):
+        alice = self.make_participant('alice')
+        e1 = self.make_exchange('mango-cc', 10, 0, alice)
+        e2 = self.make_exchange('mango-cc', 3, 0, alice, status='failed', error='oops')
+        Payday.start().run(recompute_stats=1)
+        stats = Payday.compute_stats(1)
+        assert stats['week_deposits'] == 10
+        assert self.get_stored_stats(1, stats) == stats
+
+        # The failed exchange turns out to have succeeded
+        self.db.run("UPDATE exchanges SET status = 'succeeded' WHERE id = %s", (e2,))
+        # The first exchange is refunded
+        self.db.run("""
+            INSERT INTO exchanges
+                        (amount, fee, vat, participant, status, route, refund_ref)
+                 SELECT -amount, 0, 0, participant, 'pre', route, id
+                   FROM exchanges
+                  WHERE id = %s
+        """, (e1,))
+        stats = Payday.compute_stats(1)
+        assert stats['week_deposits'] == 13
+        assert stats['week_deposits_refunded'] == 10
+        assert self.get_stored_stats(1, stats) == stats
+
+    @mock.patch('liberapay.billing.payday.log')
+    def test_recompute_stats_verify_mode_only_updates_mismatches(self, log):
+        alice = self.make_participant('alice')
+        self.make_exchange('mango-cc', 10, 0, alice)
+        Payday.start().run(recompute_stats=1)
+        stats = Payday.compute_stats(1)
+        log.reset_mock()
+        Payday.recompute_stats(verify=True)
+        assert not log.call_args_list
+
+        self.db.run("UPDATE paydays SET week_deposits = 0, nusers = 0")
+        Payday.recompute_stats(verify=True)
+        assert log.call_args_list[0][0][0] == (
+            "The stats of payday #1 were out of date (nusers, week_deposits)."
+        )
+        assert self.get_stored_stats(1, stats) == stats
+
+    def test_simulate(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        self.janet.set_tip_to(self.homer, '6.00')
+        self.janet.set_tip_to(self.david, '2.00')
+        participants = self.db.all("SELECT * FROM participants ORDER BY id")
+        tips = self.db.all("SELECT * FROM tips ORDER BY id")
+        report = simulate(self.db)
+        assert [phase['phase'] for phase in report] == [
+            'prepare', 'transfer_virtually', 'pay_invoices', 'check_balances',
+            'update_cached_amounts',
+        ]
+        transfer_virtually = report[1]
+        assert transfer_virtually['transfers'] == 2
+        assert transfer_virtually['rows_touched'] > 0
+        assert transfer_virtually['statements'] > 0
+        assert 0 <= transfer_virtually['db_time'] <= transfer_virtually['wall_time']
+        assert report[4]['statements'] == len(Payday.UPDATE_CACHED_AMOUNTS_QUERIES)
+        # Nothing has been committed
+        assert self.db.all("SELECT * FROM participants ORDER BY id") == participants
+        assert self.db.all("SELECT * FROM tips ORDER BY id") == tips
+        assert self.db.one("SELECT count(*) FROM paydays") == 0
+        assert self.db.one("SELECT count(*) FROM transfers") == 0
+
     def test_end(self):
         Payday.start().end()
         result = self.db.one("SELECT count(*) FROM paydays "
@@ -303,6 +503,157 @@ class TestPayday(EmailHarness, FakeTransfersHarness, MangopayHarness):
             assert new_balances[self.janet.id] == D('15')
             assert new_balances[self.david.id] == D('5')
 
+    def settle_with(self, engine, processes=1):
+        payday = Payday.start()
+        with mock.patch.object(Payday, 'engine', engine), \
+             mock.patch.object(Payday, 'settlement_processes', processes), \
+             self.db.get_cursor() as cursor:
+            payday.prepare(cursor, payday.ts_start)
+            payday.transfer_virtually(cursor, payday.ts_start)
+            return (
+                dict(cursor.all("""
+                    SELECT p.username, pp.new_balance
+                      FROM payday_participants pp
+                      JOIN participants p ON p.id = pp.id
+                """)),
+                [tuple(r) for r in cursor.all("""
+                    SELECT p.username AS tipper, p2.username AS tippee, t.amount, t.context
+                         , p3.username AS team
+                      FROM payday_transfers t
+                      JOIN participants p ON p.id = t.tipper
+                      JOIN participants p2 ON p2.id = t.tippee
+                 LEFT JOIN participants p3 ON p3.id = t.team
+                  ORDER BY 1, 2, 4, 5
+                """)],
+                [tuple(r) for r in cursor.all("""
+                    SELECT p.username AS tipper, p2.username AS tippee, t.is_funded
+                      FROM payday_tips t
+                      JOIN participants p ON p.id = t.tipper
+                      JOIN participants p2 ON p2.id = t.tippee
+                  ORDER BY 1, 2
+                """)],
+            )
+
+    def test_python_engine_settles_the_graph_like_the_sql_functions(self):
+        self.clear_tables()
+        team = self.make_participant('team', kind='group')
+        alice = self.make_participant('alice', balance=8)
+        bob = self.make_participant('bob', balance=10)
+        charlie = self.make_participant('charlie', balance=D('3.33'))
+        dan = self.make_participant('dan')
+        emma = self.make_participant('emma', balance=1)
+        team.set_take_for(alice, D('0.25'), team)
+        team.set_take_for(bob, D('0.75'), team)
+        team.set_take_for(dan, D('1.10'), team)
+        alice.set_tip_to(team, D('2.00'))
+        charlie.set_tip_to(team, D('0.53'))
+        Payday.start().run(recompute_stats=0, update_cached_amounts=False)
+        bob.set_tip_to(team, D('1.97'))
+        dan.set_tip_to(emma, D('1.50'))  # funded by the takes
+        emma.set_tip_to(charlie, D('2.00'))  # funded by dan's tip
+        charlie.set_tip_to(alice, D('5.00'))  # unfunded
+        alice.set_tip_to(dan, D('0.17'))
+        emma.set_tip_to(team, D('0.51'))
+
+        # These are the results of the original implementation, which called
+        # the `transfer()` SQL function once per team and per (tip, take) pair
+        expected = (
+            {'team': D('0.00'), 'alice': D('6.57'), 'bob': D('9.94'),
+             'charlie': D('4.86'), 'dan': D('0.87'), 'emma': D('0.09')},
+            [('alice', 'bob', D('0.09'), 'take', 'team'),
+             ('alice', 'dan', D('0.17'), 'tip', None),
+             ('bob', 'alice', D('0.25'), 'take', 'team'),
+             ('bob', 'dan', D('1.10'), 'take', 'team'),
+             ('charlie', 'bob', D('0.04'), 'take', 'team'),
+             ('dan', 'emma', D('1.50'), 'tip', None),
+             ('emma', 'bob', D('0.41'), 'take', 'team'),
+             ('emma', 'charlie', D('2.00'), 'tip', None)],
+            [('alice', 'dan', True), ('alice', 'team', True), ('bob', 'team', True),
+             ('charlie', 'alice', False), ('charlie', 'team', True), ('dan', 'emma', True),
+             ('emma', 'charlie', True), ('emma', 'team', True)],
+        )
+        assert self.settle_with('sql') == expected
+        assert self.settle_with('python') == expected
+        assert self.settle_with('python', processes=2) == expected
+
+    def test_takes_of_several_teams_are_resolved_in_one_batch(self):
+        self.clear_tables()
+        team1 = self.make_participant('team1', kind='group')
+        team2 = self.make_participant('team2', kind='group')
+        alice = self.make_participant('alice')
+        bob = self.make_participant('bob')
+        carol = self.make_participant('carol')
+        dan = self.make_participant('dan')
+        emma = self.make_participant('emma', balance=10)
+        frank = self.make_participant('frank', balance=10)
+        team1.set_take_for(alice, D('1.00'), team1)
+        team1.set_take_for(bob, D('0.50'), team1)
+        team2.set_take_for(carol, D('0.60'), team2)
+        team2.set_take_for(dan, D('0.40'), team2)
+        frank.set_tip_to(team2, D('0.60'))
+        Payday.start().run(recompute_stats=0, update_cached_amounts=False)
+        emma.set_tip_to(team1, D('1.20'))
+        alice.set_tip_to(team2, D('0.70'))  # funded by team1's takes
+        bob.set_tip_to(team1, D('0.30'))  # unfunded
+
+        # Frank has already given a week's worth of money to team2, so alice's
+        # new donation is used first
+        expected = (
+            {'team1': D('0.00'), 'team2': D('0.00'), 'alice': D('0.10'),
+             'bob': D('0.40'), 'carol': D('0.96'), 'dan': D('0.64'),
+             'emma': D('8.80'), 'frank': D('9.10')},
+            [('alice', 'carol', D('0.60'), 'take', 'team2'),
+             ('alice', 'dan', D('0.10'), 'take', 'team2'),
+             ('emma', 'alice', D('0.80'), 'take', 'team1'),
+             ('emma', 'bob', D('0.40'), 'take', 'team1'),
+             ('frank', 'dan', D('0.30'), 'take', 'team2')],
+            [('alice', 'team2', True), ('bob', 'team1', False),
+             ('emma', 'team1', True), ('frank', 'team2', True)],
+        )
+        assert self.settle_with('sql') == expected
+        assert self.settle_with('python') == expected
+        assert self.settle_with('python', processes=2) == expected
+
+    def test_independent_parts_of_the_graph_are_settled_in_parallel(self):
+        self.clear_tables()
+        team1 = self.make_participant('team1', kind='group')
+        team2 = self.make_participant('team2', kind='group')
+        alice = self.make_participant('alice', balance=5)
+        bob = self.make_participant('bob')
+        carol = self.make_participant('carol', balance=3)
+        dan = self.make_participant('dan')
+        emma = self.make_participant('emma', balance=2)
+        frank = self.make_participant('frank')
+        grace = self.make_participant('grace', balance=7)
+        self.make_participant('hank', balance=1)
+        team1.set_take_for(bob, D('1.00'), team1)
+        team2.set_take_for(dan, D('0.50'), team2)
+        alice.set_tip_to(team1, D('2.00'))
+        bob.set_tip_to(carol, D('1.50'))  # funded by the takes
+        carol.set_tip_to(alice, D('4.00'))  # funded by bob's tip
+        grace.set_tip_to(team2, D('0.80'))
+        dan.set_tip_to(grace, D('0.40'))  # funded by the takes
+        emma.set_tip_to(frank, D('1.00'))
+        frank.set_tip_to(emma, D('3.00'))  # unfunded
+
+        payday = Payday.start()
+        with self.db.get_cursor() as cursor:
+            payday.prepare(cursor, payday.ts_start)
+            rows = TipGraph.fetch(cursor)
+            cursor.connection.rollback()
+        components = split_components(*rows)
+        usernames = dict(self.db.all("SELECT id, username FROM participants"))
+        assert [sorted(usernames[p[0]] for p in c[0]) for c in components] == [
+            ['alice', 'bob', 'carol', 'team1'],
+            ['dan', 'grace', 'team2'],
+            ['emma', 'frank'],
+        ]
+        assert [(len(c[1]), len(c[2])) for c in components] == [(3, 1), (2, 1), (2, 0)]
+
+        expected = self.settle_with('sql')
+        assert self.settle_with('python') == expected
+        assert self.settle_with('python', processes=3) == expected
+
     def test_transfer_takes(self):
         a_team = self.make_participant('a_team', kind='group')
         alice = self.make_participant('alice')
@@ -336,6 +687,137 @@ class TestPayday(EmailHarness, FakeTransfersHarness, MangopayHarness):
             else:
                 assert p.balance == 0
 
+    def make_failed_take(self, tipper, tippee, amount, team):
+        t_id = self.db.one("""
+            INSERT INTO transfers
+                        (tipper, tippee, amount, context, team, status)
+                 VALUES (%s, %s, %s, 'take', %s, 'pre')
+              RETURNING id
+        """, (tipper, tippee, amount, team))
+        self.db.run("UPDATE transfers SET status = 'failed' WHERE id = %s", (t_id,))
+
+    def get_take_totals(self):
+        return dict(((r.tipper, r.team), r.amount) for r in self.db.all(
+            "SELECT tipper, team, amount FROM take_totals"
+        ))
+
+    def test_take_totals_are_updated_by_the_transfers_trigger(self):
+        team = self.make_participant('team', kind='group')
+        alice = self.make_participant('alice', balance=100)
+        bob = self.make_participant('bob')
+        t_id = self.db.one("""
+            INSERT INTO transfers
+                        (tipper, tippee, amount, context, team, status)
+                 VALUES (%s, %s, 1.50, 'take', %s, 'pre')
+              RETURNING id
+        """, (alice.id, bob.id, team.id))
+        assert self.get_take_totals() == {}
+        self.db.run("UPDATE transfers SET status = 'succeeded' WHERE id = %s", (t_id,))
+        assert self.get_take_totals() == {(alice.id, team.id): D('1.50')}
+        self.make_transfer(alice.id, bob.id, D('2.00'), 'take', team.id)
+        self.make_failed_take(alice.id, bob.id, D('4.00'), team.id)
+        self.make_transfer(alice.id, bob.id, D('8.00'), 'tip')
+        assert self.get_take_totals() == {(alice.id, team.id): D('3.50')}
+        self.db.run("UPDATE transfers SET status = 'failed' WHERE id = %s", (t_id,))
+        assert self.get_take_totals() == {(alice.id, team.id): D('2.00')}
+        self.db.self_check()
+
+    def test_take_totals_backfill(self):
+        team = self.make_participant('team', kind='group')
+        alice = self.make_participant('alice', balance=100)
+        bob = self.make_participant('bob', balance=100)
+        self.make_transfer(alice.id, bob.id, D('1.00'), 'take', team.id)
+        self.make_transfer(alice.id, bob.id, D('2.00'), 'take', team.id)
+        self.make_failed_take(alice.id, bob.id, D('4.00'), team.id)
+        self.make_transfer(bob.id, alice.id, D('8.00'), 'take', team.id)
+        self.make_transfer(bob.id, alice.id, D('16.00'), 'tip')
+        expected = self.get_take_totals()
+        assert expected == {(alice.id, team.id): D('3.00'), (bob.id, team.id): D('8.00')}
+        # Run the backfill query of the migration that created the table
+        for filename in ('sql/branch.sql', 'sql/migrations.sql'):
+            if not os.path.exists(filename):
+                continue
+            with open(filename) as f:
+                m = re.search(
+                    r'INSERT INTO take_totals\s+\([^)]+\)\s+SELECT .+?;', f.read(), re.S
+                )
+            if m:
+                break
+        with self.db.get_cursor() as cursor:
+            cursor.run("DELETE FROM take_totals")
+            cursor.run(m.group(0))
+        assert self.get_take_totals() == expected
+
+    @mock.patch.object(Payday, 'transfer_concurrency', 1)
+    def test_payday_resumes_after_a_crash(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        self.janet.set_tip_to(self.homer, '6.00')
+        self.janet.set_tip_to(self.david, '1.00')
+        self.homer.set_tip_to(self.david, '2.00')
+
+        payday = Payday.start()
+        calls = []
+
+        def crashing_send_transfer(db, t_id, tipper, tippee, amount, **kw):
+            calls.append(tippee)
+            tr = send_transfer(db, t_id, tipper, tippee, amount, **kw)
+            if len(calls) == 2:
+                # The transfer has been executed but its result isn't recorded
+                raise Crash
+            return tr
+
+        with mock.patch('liberapay.billing.payday.send_transfer', crashing_send_transfer):
+            with self.assertRaises(Crash):
+                payday.shuffle()
+        journal = Journal(payday.transfers_filename)
+        assert len(journal) == 3
+        assert journal.first_unfinished == 1
+        assert [(i, state) for i, state, t in journal.read()] == [(1, STARTED), (2, PENDING)]
+        journal.close()
+        # All the transfers have been inserted, the first one has been recorded
+        transfers = self.db.all("SELECT * FROM transfers ORDER BY id")
+        assert [t.status for t in transfers] == ['succeeded', 'pre', 'pre']
+
+        payday.shuffle()
+        journal = Journal(payday.transfers_filename)
+        assert journal.first_unfinished == 3
+        assert list(journal.read()) == []
+        journal.close()
+        os.unlink(payday.transfers_filename)
+
+        # The interrupted transfer isn't executed again, `sync_with_mangopay`
+        # records its result
+        assert self.transfer_mock.call_count == 3
+        transfers = self.db.all("SELECT * FROM transfers ORDER BY id")
+        assert [t.status for t in transfers] == ['succeeded', 'pre', 'succeeded']
+        _record_transfer_result(self.db, transfers[1].id, 'succeeded')
+        d = dict(self.db.all("SELECT username, balance FROM participants"))
+        assert d == {'david': D('3.00'), 'homer': D('4.00'), 'janet': D('3.00')}
+
+    def test_payday_resumes_from_a_transfers_pickle(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        payday = Payday.start()
+        self.make_transfer(self.janet.id, self.david.id, D('1.00'))
+        transfers = [NS(dict(
+            tipper=self.janet.id, tippee=tippee.id, amount=amount, context='tip',
+            team=None, invoice=None,
+            tipper_mango_id=self.janet.mangopay_user_id,
+            tippee_mango_id=tippee.mangopay_user_id,
+            tipper_wallet_id=self.janet.mangopay_wallet_id,
+            tippee_wallet_id=tippee.mangopay_wallet_id,
+        )) for tippee, amount in [(self.david, D('1.00')), (self.homer, D('6.00'))]]
+        pickle_filename = './payday-%s_transfers.pickle' % payday.id
+        with open(pickle_filename, 'wb') as f:
+            pickle.dump(transfers, f)
+
+        payday.shuffle()
+        assert not os.path.exists(pickle_filename)
+        os.unlink(payday.transfers_filename)
+
+        assert self.transfer_mock.call_count == 1
+        d = dict(self.db.all("SELECT username, balance FROM participants"))
+        assert d == {'david': D('1.00'), 'homer': D('6.00'), 'janet': D('3.00')}
+
     def test_underfunded_team(self):
         self.clear_tables()
         team = self.make_participant('team', kind='group')
@@ -709,6 +1191,35 @@ class TestPayday(EmailHarness, FakeTransfersHarness, MangopayHarness):
             'janet': D('50.02'),
         }
 
+    def test_invoices_are_paid_in_order_while_the_balance_allows_it(self):
+        org = self.make_participant('org', kind='organization', allow_invoices=True)
+        self.make_exchange('mango-cc', 100, 0, self.janet)
+        self.janet.set_tip_to(org, '50.00')
+        self.db.run("UPDATE participants SET allow_invoices = true WHERE id = %s",
+                    (self.janet.id,))
+        self.make_invoice(self.janet, org, '20.00', 'accepted')
+        self.make_invoice(self.janet, org, '25.00', 'accepted')
+        self.make_invoice(self.janet, org, '10.00', 'accepted')
+        self.make_invoice(self.janet, org, '1.00', 'accepted')
+        Payday.start().run()
+        paid = self.db.all("""
+            SELECT i.amount
+              FROM invoices i
+             WHERE i.status = 'paid'
+               AND EXISTS (SELECT 1 FROM invoice_events ie WHERE ie.invoice = i.id AND ie.status = 'paid')
+          ORDER BY i.id
+        """)
+        assert paid == [D('20.00'), D('25.00')]
+        expense_transfers = self.db.all("""
+            SELECT amount FROM transfers WHERE context = 'expense' ORDER BY id
+        """)
+        assert expense_transfers == paid
+        d = dict(self.db.all("SELECT username, balance FROM participants WHERE balance <> 0"))
+        assert d == {
+            'org': D('5.00'),
+            'janet': D('95.00'),
+        }
+
     def test_it_notifies_participants(self):
         self.make_exchange('mango-cc', 10, 0, self.janet)
         self.janet.set_tip_to(self.david, '4.50')
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from decimal import Decimal as D
+import threading
 
 import mock
 import pytest
@@ -8,10 +9,12 @@ import pytest
 from liberapay.billing import exchanges
 from liberapay.billing.exchanges import (
     charge,
+    merge_scheduled_cash_bundles,
     payin_bank_wire,
     payout,
     record_exchange,
     record_exchange_result,
+    record_transfer_results,
     skim_credit,
     sync_with_mangopay,
     transfer,
@@ -354,9 +357,13 @@ class TestCashBundles(FakeTransfersHarness, MangopayHarness):
         transfer(self.db, self.janet.id, self.homer.id, D('10.00'), 'tip')
         assert bundles_count() == 2
         transfer(self.db, self.homer.id, self.janet.id, D('5.00'), 'tip')
+        assert bundles_count() == 3
+        assert merge_scheduled_cash_bundles(self.db) == 2
         assert bundles_count() == 2
         transfer(self.db, self.homer.id, self.janet.id, D('5.00'), 'tip')
+        assert merge_scheduled_cash_bundles(self.db) == 1
         assert bundles_count() == 1
+        assert merge_scheduled_cash_bundles(self.db) == 0
         self.db.self_check()
 
     def test_cash_bundles_are_merged_after_payout_failure(self):
@@ -364,9 +371,120 @@ class TestCashBundles(FakeTransfersHarness, MangopayHarness):
         self.make_exchange('mango-cc', 46, 0, self.homer)
         assert bundles_count() == 1
         self.make_exchange('mango-cc', -40, 0, self.homer, status='failed')
+        assert bundles_count() == 2
+        merge_scheduled_cash_bundles(self.db)
         assert bundles_count() == 1
         self.db.self_check()
 
+    def test_cash_bundles_are_moved_in_batches_like_one_by_one(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        self.make_exchange('mango-cc', 5, 0, self.homer)
+        self.make_exchange('mango-cc', 1, 0, self.david)
+        p = dict(janet=self.janet.id, homer=self.homer.id, david=self.david.id)
+        t_ids = [self.db.one("""
+            INSERT INTO transfers
+                        (tipper, tippee, amount, context, status)
+                 VALUES (%s, %s, %s, 'tip', 'pre')
+              RETURNING id
+        """, (p[tipper], p[tippee], D(amount))) for tipper, tippee, amount in [
+            ('janet', 'homer', '6.00'), ('janet', 'david', '1.00'),
+            ('homer', 'david', '8.00'), ('david', 'janet', '3.00'),
+            ('homer', 'janet', '2.00'), ('david', 'homer', '5.50'),
+        ]]
+        record_transfer_results(self.db, [(t_id, 'succeeded', None) for t_id in t_ids])
+        merge_scheduled_cash_bundles(self.db)
+        # These are the results of recording the same transfers one by one
+        # with `_record_transfer_result`
+        bundles = self.db.all("""
+            SELECT p.username AS owner, p2.username AS origin, b.amount
+              FROM cash_bundles b
+              JOIN participants p ON p.id = b.owner
+              JOIN exchanges e ON e.id = b.origin
+              JOIN participants p2 ON p2.id = e.participant
+          ORDER BY 1, 2
+        """)
+        assert [tuple(b) for b in bundles] == [
+            ('david', 'david', D('1.00')), ('david', 'janet', D('0.50')),
+            ('homer', 'homer', D('3.00')), ('homer', 'janet', D('3.50')),
+            ('janet', 'homer', D('2.00')), ('janet', 'janet', D('6.00')),
+        ]
+        d = dict(self.db.all("SELECT username, balance FROM participants"))
+        assert d == {'david': D('1.50'), 'homer': D('6.50'), 'janet': D('8.00')}
+        self.db.self_check()
+
+    def test_record_transfer_results_refuses_negative_balances(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        t_id = self.db.one("""
+            INSERT INTO transfers
+                        (tipper, tippee, amount, context, status)
+                 VALUES (%s, %s, 11, 'tip', 'pre')
+              RETURNING id
+        """, (self.janet.id, self.homer.id))
+        with self.assertRaises(NegativeBalance):
+            record_transfer_results(self.db, [(t_id, 'succeeded', None)])
+        assert self.db.one("SELECT status FROM transfers") == 'pre'
+        assert self.janet.refetch().balance == 10
+
+    def test_cash_bundles_of_unrelated_participants_are_not_locked(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        self.make_exchange('mango-cc', 10, 0, self.homer)
+        done = threading.Event()
+        with self.db.get_cursor() as cursor:
+            exchanges.merge_cash_bundles(cursor, self.janet.id)
+            t = threading.Thread(target=lambda: (
+                transfer(self.db, self.homer.id, self.david.id, D('4.00'), 'tip'),
+                done.set(),
+            ))
+            t.start()
+            assert done.wait(10)
+            # A transfer from janet has to wait
+            t = threading.Thread(target=transfer, args=(
+                self.db, self.janet.id, self.david.id, D('1.00'), 'tip'
+            ))
+            t.start()
+            t.join(0.5)
+            assert t.is_alive()
+        t.join()
+        d = dict(self.db.all("SELECT username, balance FROM participants"))
+        assert d == {'david': D('5.00'), 'homer': D('6.00'), 'janet': D('9.00')}
+        self.db.self_check()
+
+
+class TestMangoIdsCache(MangopayHarness):
+
+    def test_get_mango_ids(self):
+        alice = self.make_participant('alice', mangopay_user_id='-1', mangopay_wallet_id=None)
+        ids = exchanges.get_mango_ids(self.db, self.janet.id, alice.id)
+        assert ids == {
+            self.janet.id: (self.janet.mangopay_user_id, self.janet.mangopay_wallet_id),
+            alice.id: ('-1', None),
+        }
+        # Only complete pairs are cached
+        assert list(exchanges.mango_ids_cache) == [self.janet.id]
+        self.db.run("UPDATE participants SET mangopay_wallet_id = '-2' WHERE id = %s",
+                    (self.janet.id,))
+        ids = exchanges.get_mango_ids(self.db, self.janet.id)
+        assert ids[self.janet.id][1] == self.janet.mangopay_wallet_id
+        exchanges.forget_mango_ids(self.janet.id)
+        ids = exchanges.get_mango_ids(self.db, self.janet.id)
+        assert ids[self.janet.id][1] == '-2'
+
+    @mock.patch.object(exchanges, 'MANGO_IDS_CACHE_SIZE', 2)
+    def test_mango_ids_cache_is_bounded(self):
+        exchanges.get_mango_ids(self.db, self.janet.id, self.homer.id)
+        exchanges.get_mango_ids(self.db, self.janet.id)
+        exchanges.get_mango_ids(self.db, self.david.id)
+        assert list(exchanges.mango_ids_cache) == [self.janet.id, self.david.id]
+
+    @mock.patch('liberapay.billing.exchanges.Wallet.save', autospec=True)
+    def test_create_wallet_invalidates_the_cache(self, save):
+        def fake_save(w):
+            w.Id = '-3'
+        save.side_effect = fake_save
+        exchanges.get_mango_ids(self.db, self.janet.id)
+        exchanges.create_wallet(self.db, self.janet)
+        assert exchanges.get_mango_ids(self.db, self.janet.id)[self.janet.id][1] == '-3'
+
 
 class TestSync(MangopayHarness):
 
@@ -439,3 +557,31 @@ class TestSync(MangopayHarness):
         assert not transfers
         assert Participant.from_username('david').balance == 0
         assert Participant.from_username('janet').balance == 10
+
+    def test_sync_with_mangopay_transfers_fetches_the_transactions_of_each_user_once(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        self.make_exchange('mango-cc', 10, 0, self.homer)
+        t_ids = [self.db.one("""
+            INSERT INTO transfers
+                        (tipper, tippee, amount, context, status)
+                 VALUES (%s, %s, %s, 'tip', 'pre')
+              RETURNING id
+        """, (tipper.id, tippee.id, amount)) for tipper, tippee, amount in [
+            (self.janet, self.david, 4), (self.janet, self.homer, 3), (self.homer, self.david, 2),
+        ]]
+        fake = lambda t_id, type: mock.Mock(
+            Tag=str(t_id), Type=type, Status='SUCCEEDED', ResultCode='000000'
+        )
+        transactions = {
+            self.janet.mangopay_user_id: [fake(t_ids[0], 'TRANSFER'), fake(t_ids[1], 'PAYIN')],
+            self.homer.mangopay_user_id: [fake(t_ids[2], 'TRANSFER')],
+        }
+        with mock.patch('liberapay.billing.exchanges.Transaction.all') as all_transactions:
+            all_transactions.side_effect = lambda user_id: transactions[user_id]
+            sync_with_mangopay(self.db, concurrency=2)
+        user_ids = sorted(c[1]['user_id'] for c in all_transactions.call_args_list)
+        assert user_ids == sorted(transactions)
+        statuses = dict(self.db.all("SELECT id, status FROM transfers"))
+        assert statuses == {t_ids[0]: 'succeeded', t_ids[2]: 'succeeded'}
+        d = dict(self.db.all("SELECT username, balance FROM participants"))
+        assert d == {'david': 6, 'homer': 8, 'janet': 6}
@@ -136,6 +136,16 @@ class Tests2(Harness):
         r = self.client.POST('/', csrf_token=False, raise_immediately=False)
         assert r.code == 403
 
+    def test_identity_map_is_used_for_safe_requests_only(self):
+        alice = self.make_participant('alice')
+        bob = self.make_participant('bob')
+        alice.set_tip_to(bob, '1.00')
+        r = self.client.GET('/bob/', auth_as=alice)
+        assert r.headers[b'X-Identity-Map'] == b'hits=0, misses=1'
+        r = self.client.PxST('/bob/settings/edit', {'username': 'bobby'}, auth_as=bob)
+        assert r.code == 302
+        assert b'X-Identity-Map' not in r.headers
+
     def test_cors_is_not_allowed_by_default(self):
         r = self.client.GET('/')
         assert b'Access-Control-Allow-Origin' not in r.headers
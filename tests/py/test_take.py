@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 
 from decimal import Decimal as D
 
+import mock
 from psycopg2 import InternalError
 
 from liberapay.testing import Harness
@@ -188,6 +189,27 @@ class Tests(Harness):
         alice = Participant.from_username('alice')
         assert alice.receiving == alice.taking == 25
 
+    def test_update_giving_and_tippees_updates_the_takes_of_several_teams_at_once(self):
+        team, alice, bob = self.make_team_of_two()
+        team2 = self.make_team('B Team')
+        team2.add_member(alice)
+        team.set_take_for(alice, D('30.00'), team, check_max=False)
+        team.set_take_for(bob, D('80.00'), team, check_max=False)
+        team2.set_take_for(alice, D('30.00'), team2, check_max=False)
+        alice = alice.refetch()
+        assert alice.taking == alice.receiving == D('57.28')
+        self.db.run("UPDATE participants SET balance = 150 WHERE id = %s", (self.warbucks.id,))
+        warbucks = self.warbucks.refetch()
+        with self.db.get_cursor() as cursor:
+            with mock.patch.object(cursor, 'execute', wraps=cursor.execute) as execute:
+                warbucks.update_giving_and_tippees(cursor)
+        # The number of queries doesn't depend on the number of tips or teams
+        assert execute.call_count == 7
+        alice, bob, team2 = alice.refetch(), bob.refetch(), team2.refetch()
+        assert team2.receiving == 0
+        assert alice.taking == alice.receiving == D('27.28')
+        assert bob.taking == bob.receiving == D('72.72')
+
     # get_takes_last_week - gtlw
 
     def test_gtlwf_works_during_payday(self):
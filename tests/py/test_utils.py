@@ -2,13 +2,20 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 from datetime import datetime
 from datetime import timedelta
+import os
+import shutil
+import tempfile
+import threading
+import time
 
+import mock
 from pando.http.response import Response
 from markupsafe import escape
 
 from liberapay import utils
 from liberapay.testing import Harness
-from liberapay.utils import i18n, markdown, b64encode_s, b64decode_s
+from liberapay.utils import i18n, markdown, b64encode_s, b64decode_s, query_cache
+from liberapay.utils.query_cache import FormattingError, QueryCache
 
 
 class Tests(Harness):
@@ -172,3 +179,178 @@ class Tests(Harness):
 
     def test_b64decode_s_returns_default_if_passed_on_error(self):
         assert b64decode_s('abcd', default='error') == 'error'
+
+    # QueryCache
+    # ==========
+
+    def test_query_cache_returns_cached_results(self):
+        qc = QueryCache(self.db, threshold=60, shards=2)
+        q = "SELECT count(*) FROM participants"
+        assert qc.one(q) == 0
+        self.make_participant('alice')
+        assert qc.one(q) == 0
+        assert qc.one(q + " -- 2") == 1
+        stats = qc.stats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 2)
+
+    def test_query_cache_evicts_the_least_recently_used_entries(self):
+        qc = QueryCache(self.db, threshold=60, shards=1, max_entries=2)
+        q = "SELECT %s"
+        qc.one(q, (1,))
+        qc.one(q, (2,))
+        qc.one(q, (1,))
+        qc.one(q, (3,))
+        assert list(qc.shards[0].cache) == [(q, (1,)), (q, (3,))]
+        stats = qc.stats()
+        assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 3, 1)
+
+    def test_query_cache_evicts_entries_when_it_gets_too_big(self):
+        qc = QueryCache(self.db, threshold=60, shards=1, max_size=10000)
+        q = "SELECT repeat('x', %s)"
+        qc.one(q, (3000,))
+        qc.one(q, (4000,))
+        assert qc.stats()['evictions'] == 0
+        qc.one(q, (5000,))
+        stats = qc.stats()
+        assert stats['evictions'] == 1
+        assert stats['entries'] == 2
+        assert 9000 < stats['size'] <= 10000
+
+    def test_query_cache_is_thread_safe(self):
+        class FakeDB(object):
+            def one(self, query, params):
+                time.sleep(0.001)
+                return params[0]
+
+        qc = QueryCache(FakeDB(), threshold=60, shards=4, max_entries=8)
+        errors = []
+
+        def f(i):
+            try:
+                for j in range(50):
+                    n = (i * j) % 20
+                    assert qc.one("SELECT %s", (n,)) == n
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=f, args=(i,)) for i in range(32)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors
+        stats = qc.stats()
+        assert stats['hits'] + stats['misses'] == 32 * 50
+        # Entries that are in use can't be evicted, so the limit can be
+        # exceeded by up to one entry per thread
+        assert stats['entries'] <= 8 + len(threads)
+
+    def test_query_cache_serves_stale_results_while_refreshing_them(self):
+        calls = []
+        can_refresh = threading.Event()
+
+        class FakeDB(object):
+            def one(self, query, params):
+                calls.append(params)
+                if len(calls) == 2:
+                    can_refresh.wait(5)
+                    raise ValueError("the refresh failed")
+                return len(calls)
+
+        qc = QueryCache(FakeDB(), threshold=0.5, stale_ttl=60, shards=1)
+        q = "SELECT 1"
+        assert qc.one(q) == 1
+        time.sleep(0.6)
+        # The stale result is returned, and only one refresh is started
+        assert qc.one(q) == 1
+        assert qc.one(q) == 1
+        can_refresh.set()
+        for i in range(50):
+            if qc.stats()['refreshes']:
+                break
+            time.sleep(0.1)
+        # Exceptions are never served stale
+        with self.assertRaises(FormattingError):
+            qc.one(q)
+        time.sleep(0.6)
+        assert qc.one(q) == 3
+        assert len(calls) == 3
+        stats = qc.stats()
+        assert (stats['hits'], stats['stale_hits'], stats['misses'], stats['refreshes']) == \
+               (1, 2, 2, 1)
+
+    def test_query_cache_prunes_expired_entries(self):
+        qc = QueryCache(self.db, threshold=0, threshold_prune=0.2, shards=1)
+        qc.one("SELECT 1")
+        qc.one("SELECT 2")
+        time.sleep(0.3)
+        # Accessing the cache prunes the expired entries
+        qc.one("SELECT 3")
+        assert list(qc.shards[0].cache) == [("SELECT 3", None)]
+        time.sleep(0.3)
+        qc.prune()
+        assert not qc.shards[0].cache
+        assert not qc.shards[0].expiries
+
+    def test_query_caches_share_one_pruning_thread(self):
+        QueryCache(self.db)
+        thread = query_cache.pruner.thread
+        QueryCache(self.db)
+        assert query_cache.pruner.thread is thread
+        assert thread.is_alive()
+
+    def test_query_cache_shares_results_between_processes(self):
+        shared_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_dir)
+        # Two caches with the same directory behave like two gunicorn workers
+        qc1 = QueryCache(self.db, threshold=60, shards=1, shared_dir=shared_dir)
+        qc2 = QueryCache(self.db, threshold=60, shards=1, shared_dir=shared_dir)
+        q = "SELECT 1 AS a, 'foo' AS b, count(*) AS c FROM participants"
+        r1 = qc1.all(q)
+        self.make_participant('alice')
+        r2 = qc2.all(q)
+        assert r2 == r1 == [(1, 'foo', 0)]
+        assert r2[0].b == 'foo'
+        assert r2[0]._asdict() == r1[0]._asdict()
+        assert qc1.stats()['misses'] == 1
+        assert qc2.stats()['misses'] == 0
+        assert qc2.stats()['shared_hits'] == 1
+        # Results that can't be serialized aren't shared
+        assert qc1.one("SELECT 2", process=lambda r: threading.Lock()) is not None
+        assert qc2.one("SELECT 2", process=lambda r: r) == 2
+        # Old results are pruned
+        qc1.threshold_prune = 0
+        qc1.prune()
+        assert not os.listdir(shared_dir)
+
+    def test_query_cache_drops_tagged_results_when_the_tables_change(self):
+        listener = query_cache.Listener()
+        self.addCleanup(mock.patch.stopall)
+        mock.patch.object(query_cache, 'listener', listener).start()
+        qc = QueryCache(self.db, threshold=0, tagged_threshold=60, shards=1)
+        q = "SELECT count(*) FROM participants"
+        # Tagged results aren't cached until the listener is connected
+        assert qc.one(q, tags=('participants',)) == 0
+        assert qc.stats()['misses'] == 1
+        listener.start(os.environ['DATABASE_URL'])
+        self.wait_for(lambda: listener.listening)
+        assert qc.one(q, tags=('participants',)) == 0
+        assert qc.one(q, tags=('participants',)) == 0
+        assert qc.stats()['hits'] == 1
+        # A change in another table doesn't invalidate the result
+        self.db.run("SELECT pg_notify('query_cache', 'tips')")
+        self.wait_for(lambda: 'tips' in listener.invalidated)
+        assert qc.one(q, tags=('participants',)) == 0
+        assert qc.stats()['hits'] == 2
+        # A change in the participants table does
+        self.make_participant('alice')
+        self.wait_for(lambda: 'participants' in listener.invalidated)
+        assert qc.one(q, tags=('participants',)) == 1
+        assert qc.stats()['misses'] == 3
+
+    @staticmethod
+    def wait_for(condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline
+            time.sleep(0.01)